@@ -2,218 +2,603 @@
 import paho.mqtt.client as mqtt
 import json
 import time
+import os
+import hashlib
+import sqlite3
+import queue
+import threading
+from collections import OrderedDict
+# Use orjson for parsing if it's available, it's several times faster
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 # help with docker
 # docker build -t stewythe1st/home-automation-scripts-acurite .
 # docker tag stewythe1st/home-automation-scripts-acurite:latest stewythe1st/home-automation-scripts-acurite:v0.0.x
 # docker push stewythe1st/home-automation-scripts-acurite:v0.0.x
 
-client = mqtt.Client()
+# Set to run several instances splitting the rtl_433 traffic between them
+# with an MQTT v5 shared subscription. All instances must share ACURITE_DB,
+# which is then also used as the dedup store. It's SQLite in WAL mode, so
+# they must all run on one host with the file on a local volume.
+SHARE_GROUP = os.environ.get("ACURITE_SHARE_GROUP")
 
-def on_connect(client, userdata, flags, rc):
+if SHARE_GROUP:
+    client = mqtt.Client(protocol=mqtt.MQTTv5)
+else:
+    client = mqtt.Client()
+
+# Sensors send every reading as a burst of identical packets. Repeats of the
+# last reading forwarded for a device inside this window (seconds) are
+# dropped. A different reading is always forwarded, even one that repeats an
+# earlier reading (a door opening again, a second button press).
+DEDUP_WINDOW = 2.0
+# Per-model overrides of DEDUP_WINDOW
+DEDUP_WINDOWS = {
+    "Smoke-GS558": 5.0,
+}
+DEDUP_MAX_SIZE = 1024
+# Every device ever seen is kept here so discovery survives container restarts
+REGISTRY_PATH = os.environ.get("ACURITE_DB", "acurite.db")
+# How often (seconds) last-seen times are written back to disk
+REGISTRY_FLUSH_PERIOD = 60
+# Messages are queued by the MQTT network thread and handled by worker threads
+INTAKE_QUEUE_SIZE = int(os.environ.get("ACURITE_QUEUE_SIZE", 1000))
+INTAKE_WORKERS = int(os.environ.get("ACURITE_WORKERS", 1))
+# What to do when the queue is full, "drop_oldest" or "block"
+INTAKE_OVERFLOW = os.environ.get("ACURITE_OVERFLOW", "drop_oldest")
+# How often (seconds) queue statistics are printed
+INTAKE_STATS_PERIOD = 300
+# Re-registration publishes are paced to this many per second, sent in
+# batches of REGISTER_BATCH_SIZE, so a register request doesn't flood HA
+REGISTER_RATE = float(os.environ.get("ACURITE_REGISTER_RATE", 20))
+REGISTER_BATCH_SIZE = 5
+# Fields rtl_433 changes between repeats of the same transmission
+VOLATILE_FIELDS = ("time", "rssi", "snr", "noise", "freq", "freq1", "freq2", "sequence_num")
+
+# Only the topics the bridge actually consumes, so we don't decode every
+# message on the broker (including our own republishes)
+SUBSCRIPTIONS = [
+    "rtl_433",
+    "homeassistant/register",
+]
+if SHARE_GROUP:
+    # Each message goes to only one instance of the group
+    SUBSCRIPTIONS = ["$share/%s/%s" % (SHARE_GROUP, topic) for topic in SUBSCRIPTIONS]
+
+def on_connect(client, userdata, flags, rc, properties = None):
     if rc == 0:
         print("Connected")
-        client.subscribe("#")
+        for topic in SUBSCRIPTIONS:
+            client.subscribe(topic)
     else:
-        print("Error connecting (%i)" % rc)
+        print("Error connecting (%s)" % rc)
+
+# Stable across processes, so instances sharing a dedup store agree on it
+def fingerprint(data):
+    fields = [(k, str(v)) for k, v in sorted(data.items()) if k not in VOLATILE_FIELDS]
+    return hashlib.blake2b(repr(fields).encode(), digest_size=8).hexdigest()
+
+class DedupCache:
+    def __init__(self, window = DEDUP_WINDOW, windows = DEDUP_WINDOWS, max_size = DEDUP_MAX_SIZE):
+        self.window = window
+        self.windows = windows
+        self.max_size = max_size
+        self.entries = OrderedDict() # (model, id) -> (last fingerprint forwarded, expiry time)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.store = None # shared with other instances, see DeviceRegistry.claim
+
+    def is_duplicate(self, data):
+        now = time.monotonic()
+        model = data.get("model")
+        key = (model, data.get("id"))
+        digest = fingerprint(data)
+        window = self.windows.get(model, self.window)
+        # Other instances forward some of this device's readings too, so what
+        # this one forwarded last may be stale. The shared store decides.
+        if self.store is not None:
+            if not self.store.claim("%s/%s" % key, digest, window):
+                with self.lock:
+                    self.dropped = self.dropped + 1
+                return True
+            return False
+        with self.lock:
+            last = self.entries.get(key)
+            if last is not None and last[0] == digest and last[1] > now:
+                self.dropped = self.dropped + 1
+                return True
+            self.entries[key] = (digest, now + window)
+            self.entries.move_to_end(key)
+            # Oldest entries are at the front, drop them once expired or over size
+            while self.entries:
+                oldest = next(iter(self.entries.values()))
+                if oldest[1] > now and len(self.entries) <= self.max_size:
+                    break
+                self.entries.popitem(last=False)
+        return False
+
+dedup = DedupCache()
+
+class Intake:
+    def __init__(self, size = INTAKE_QUEUE_SIZE, workers = INTAKE_WORKERS, overflow = INTAKE_OVERFLOW):
+        self.queue = queue.Queue(size)
+        self.workers = workers
+        self.overflow = overflow
+        self.dropped = 0
+        self.processed = 0
+        self.max_depth = 0
+        self.dwell_total = 0.0
+        self.dwell_max = 0.0
+        self.last_stats = time.monotonic()
+        self.lock = threading.Lock()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.run, name="intake-%u" % i, daemon=True)
+            thread.start()
+
+    # Called from the MQTT network thread, must not do any real work
+    def put(self, client, msg):
+        item = (time.monotonic(), client, msg)
+        if self.overflow == "block":
+            self.queue.put(item)
+        else:
+            while True:
+                try:
+                    self.queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                        self.queue.task_done()
+                        self.dropped = self.dropped + 1
+                    except queue.Empty:
+                        pass
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def run(self):
+        while True:
+            queued, client, msg = self.queue.get()
+            now = time.monotonic()
+            dwell = now - queued
+            try:
+                process_message(client, msg)
+            except Exception as e:
+                print("Error handling %s message: %s" % (msg.topic, e))
+            with self.lock:
+                self.processed = self.processed + 1
+                self.dwell_total = self.dwell_total + dwell
+                if dwell > self.dwell_max:
+                    self.dwell_max = dwell
+                if now - self.last_stats > INTAKE_STATS_PERIOD:
+                    self.last_stats = now
+                    print(self.stats())
+            self.queue.task_done()
+
+    def stats(self):
+        return "Queue depth %u (max %u), dwell avg %.1fms max %.1fms, %u processed, %u dropped" % \
+            (self.queue.qsize(), self.max_depth,
+             1000 * self.dwell_total / max(self.processed, 1), 1000 * self.dwell_max,
+             self.processed, self.dropped)
+
+intake = None
 
 def on_message(client, userdata, msg):
+    if intake is not None:
+        intake.put(client, msg)
+    else:
+        process_message(client, msg)
+
+def process_message(client, msg):
     if msg.topic == "rtl_433":
+        # Only routing fields are read from the parsed data, the original
+        # payload bytes are what gets forwarded
         try:
-            data = str(msg.payload.decode("utf-8", "ignore"))
-            data = json.loads(data)
-        except:
+            data = json_loads(msg.payload)
+        except ValueError:
             print("Error decoding json: %s" % str(msg.payload))
-        if "model" in data:
-            if data["model"] == "Acurite-Tower":
-                acurite_handle_data(data)
-            if data["model"] == "Generic-Remote":
-                door_sensor_handle_data(data)
-            if data["model"] == "Smoke-GS558":
-                button_handle_data(data)
+            return
+        if isinstance(data, dict) and "model" in data:
+            handler = handlers.get(data["model"])
+            if handler is not None and not dedup.is_duplicate(data):
+                handler.handle_data(client, data, msg.payload)
     elif msg.topic == "homeassistant/register":
-        print("Re-registering all...")
-        acurite_register_all()
-        door_sensor_register_all()
-        button_register_all()
-
-acurite_known_ids = []
-def acurite_handle_data(data):
-    if "id" in data:
-        id = data["id"]
-        if id not in acurite_known_ids:
-            acurite_register(id)
-            acurite_known_ids.append(id)
+        print("Re-registering all... (%u duplicate packets dropped so far)" % dedup.dropped)
+        if intake is not None:
+            print(intake.stats())
+        paced = registrar.wrap(client)
+        for handler in handlers.values():
+            handler.register_all(paced)
+
+class Registrar:
+    def __init__(self, rate = REGISTER_RATE, batch_size = REGISTER_BATCH_SIZE):
+        self.period = batch_size / rate
+        self.batch_size = batch_size
+        # topic -> (client, payload, retain), a newer publish to the same
+        # topic replaces one still waiting
+        self.pending = OrderedDict()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="registrar", daemon=True)
+        self.thread.start()
+
+    # Something with a client-like publish() that goes through the pacer
+    def wrap(self, client):
+        registrar = self
+        class PacedClient:
+            def publish(self, topic, payload = None, qos = 0, retain = False):
+                registrar.publish(client, topic, payload, retain)
+        return PacedClient()
+
+    def publish(self, client, topic, payload, retain = False):
+        if self.thread is None:
+            client.publish(topic, payload, retain=retain)
+            return
+        with self.condition:
+            self.pending[topic] = (client, payload, retain)
+            self.condition.notify()
+
+    # A live reading supersedes anything still waiting for its topic, like
+    # the dummy "closed" sent after a door sensor's config
+    def cancel(self, topic):
+        with self.condition:
+            self.pending.pop(topic, None)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                batch = []
+                while self.pending and len(batch) < self.batch_size:
+                    batch.append(self.pending.popitem(last=False))
+                remaining = len(self.pending)
+            for topic, (client, payload, retain) in batch:
+                client.publish(topic, payload, retain=retain)
+            if remaining:
+                time.sleep(self.period)
+            else:
+                print("Re-registration done")
+
+registrar = Registrar()
+
+class DeviceRegistry:
+    def __init__(self, path = REGISTRY_PATH, shared = bool(SHARE_GROUP)):
+        # Used from the intake workers, access is serialized by self.lock.
+        # When shared, other processes write to the same database.
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.shared = shared
+        if shared:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS devices ("
+                        "model TEXT NOT NULL, "
+                        "id NOT NULL, "
+                        "first_seen REAL NOT NULL, "
+                        "last_seen REAL NOT NULL, "
+                        "config_hash TEXT, "
+                        "PRIMARY KEY (model, id))")
+        # Last reading forwarded for each device, see DedupCache
+        self.db.execute("CREATE TABLE IF NOT EXISTS latest ("
+                        "device TEXT PRIMARY KEY, "
+                        "fingerprint TEXT NOT NULL, "
+                        "expires REAL NOT NULL)")
+        self.db.commit()
+        self.devices = {} # (model, id) -> config hash
+        for model, id, config_hash in self.db.execute("SELECT model, id, config_hash FROM devices"):
+            self.devices[(model, id)] = config_hash
+        self.last_seen = {} # (model, id) -> time, not yet written to disk
+        self.last_flush = time.time()
+
+    def seen(self, model, id):
+        now = time.time()
+        key = (model, id)
+        with self.lock:
+            if key not in self.devices:
+                self.devices[key] = None
+                self.db.execute("INSERT OR IGNORE INTO devices VALUES (?, ?, ?, ?, NULL)", (model, id, now, now))
+                self.db.commit()
+            else:
+                self.last_seen[key] = now
+                if now - self.last_flush > REGISTRY_FLUSH_PERIOD:
+                    self.flush()
+
+    # Caller must hold self.lock
+    def flush(self):
+        self.db.executemany("UPDATE devices SET last_seen = ? WHERE model = ? AND id = ?",
+                            [(t, model, id) for (model, id), t in self.last_seen.items()])
+        self.db.execute("DELETE FROM latest WHERE expires <= ?", (time.time(),))
+        self.db.commit()
+        self.last_seen.clear()
+        self.last_flush = time.time()
+
+    def ids(self, model):
+        with self.lock:
+            if self.shared:
+                # Includes devices only other instances have seen
+                return [id for (id,) in self.db.execute("SELECT id FROM devices WHERE model = ?", (model,))]
+            return [id for (m, id) in self.devices if m == model]
+
+    # Returns True if the config differs from the one last sent for this
+    # device, by this or any other instance sharing the database
+    def update_config(self, model, id, config_hash):
+        with self.lock:
+            if self.devices.get((model, id)) == config_hash:
+                return False
+            self.devices[(model, id)] = config_hash
+            cursor = self.db.execute("UPDATE devices SET config_hash = ? "
+                                     "WHERE model = ? AND id = ? AND config_hash IS NOT ?",
+                                     (config_hash, model, id, config_hash))
+            self.db.commit()
+        return cursor.rowcount > 0
+
+    # Atomically records fingerprint as the device's latest reading for
+    # window seconds. Returns False if some instance already forwarded that
+    # same reading as the latest one within its window.
+    def claim(self, device, fingerprint, window):
+        now = time.time()
+        with self.lock:
+            cursor = self.db.execute("INSERT INTO latest VALUES (?, ?, ?) "
+                                     "ON CONFLICT(device) DO UPDATE SET "
+                                     "fingerprint = excluded.fingerprint, expires = excluded.expires "
+                                     "WHERE latest.expires <= ? OR latest.fingerprint != excluded.fingerprint",
+                                     (device, fingerprint, now + window, now))
+            self.db.commit()
+        return cursor.rowcount > 0
+
+registry = DeviceRegistry()
+if SHARE_GROUP:
+    dedup.store = registry
+
+def config_hash(configs):
+    digest = hashlib.sha1()
+    for topic, payload in configs:
+        digest.update(topic.encode())
+        digest.update(payload)
+    return digest.hexdigest()
+
+# Maps rtl_433 model names to the handler responsible for them. New sensor
+# types just need a Handler subclass decorated with @handler("<model>").
+handlers = {}
+
+def handler(model):
+    def decorator(cls):
+        cls.model = model
+        handlers[model] = cls()
+        return cls
+    return decorator
+
+class Handler:
+    model = None
+    state_topic_format = None # e.g. "homeassistant/acurite-tower/%s"
+
+    def __init__(self):
+        self.checked_ids = set() # ids whose discovery config is known to be current
+        self.config_cache = {} # id -> [(topic, serialized config)]
+        self.state_topics = {} # id -> state topic
+
+    def handle_data(self, client, data, payload):
+        if "id" in data:
+            id = data["id"]
+            registry.seen(self.model, id)
+            if id not in self.checked_ids:
+                # Only (re-)announce devices whose discovery config actually changed
+                if registry.update_config(self.model, id, config_hash(self.configs(id))):
+                    self.register(client, id)
+                self.checked_ids.add(id)
+            registrar.cancel(self.state_topic(id))
+            self.forward(client, id, data, payload)
+
+    def register_all(self, client):
+        for id in registry.ids(self.model):
+            self.register(client, id)
+
+    def register(self, client, id):
+        for topic, payload in self.configs(id):
+            client.publish(topic, payload)
+
+    # Discovery configs only depend on the id, so they're serialized once
+    def configs(self, id):
+        configs = self.config_cache.get(id)
+        if configs is None:
+            configs = [(topic, payload.encode()) for topic, payload in self.build_configs(id)]
+            self.config_cache[id] = configs
+        return configs
+
+    # Formatted once per id, not on every packet
+    def state_topic(self, id):
+        topic = self.state_topics.get(id)
+        if topic is None:
+            topic = self.state_topic_format % id
+            self.state_topics[id] = topic
+        return topic
+
+    # List of (topic, payload) discovery configs for this device
+    def build_configs(self, id):
+        raise NotImplementedError
+
+    def forward(self, client, id, data, payload):
+        raise NotImplementedError
+
+@handler("Acurite-Tower")
+class AcuriteTower(Handler):
+    state_topic_format = "homeassistant/acurite-tower/%s"
+
+    def forward(self, client, id, data, payload):
+        if "temperature_C" not in data:
+            return
         temp_f = data["temperature_C"] * 9/5 + 32
         # Bumping this up for my stupid attic fan that wasn't working and the attic was getting insanely hot.
         if temp_f < 140 and temp_f > -20:
             print("Forwarding data from Acurite %s" % id)
-            topic = "homeassistant/acurite-tower/%s" % id
-            client.publish(topic, json.dumps(data))
-
-def acurite_register_all():
-    for id in acurite_known_ids:
-        acurite_register(id)
-
-def acurite_register(id):
-    print("Registering Acurite %s with Home Assistant" % id)
-    unique_id = "acurite-tower-%s" % id
-    device = {
-        "identifiers": unique_id,
-        "name": "Acurite Thermometer %s" % id,
-        "model": "Acurite-Tower",
-        "manufacturer": "Acurite",
-    }
-    # Temperature
-    topic = "homeassistant/sensor/%s-temperature/config" % unique_id
-    data = {
-        "name": "Temperature",
-        "icon": "mdi:thermometer",
-        "device_class": "temperature",
-        "unique_id": "%s-temperature" % unique_id,
-        "object_id": "%s-temperature" % unique_id,
-        "state_topic": "homeassistant/acurite-tower/%s" % id,
-        "state_class": "measurement",
-        "unit_of_measurement": "°C",
-        "value_template": "{{ value_json.temperature_C }}",
-        "device": device,
-    }
-    client.publish(topic, json.dumps(data))
-    # Humidity
-    topic = "homeassistant/sensor/%s-humidity/config" % unique_id
-    data = {
-        "name": "Humidity",
-        "icon": "mdi:cloud-percent",
-        "device_class": "humidity",
-        "unique_id": "%s-humidity" % unique_id,
-        "object_id": "%s-humidity" % unique_id,
-        "state_topic": "homeassistant/acurite-tower/%s" % id,
-        "state_class": "measurement",
-        "unit_of_measurement": "%",
-        "value_template": "{{ value_json.humidity }}",
-        "device": device,
-    }
-    client.publish(topic, json.dumps(data))
-    # Battery
-    topic = "homeassistant/binary_sensor/%s-battery/config" % unique_id
-    data = {
-        "name": "Battery",
-        "icon": "mdi:battery-charging",
-        "device_class": "battery",
-        "unique_id": "%s-battery" % unique_id,
-        "object_id": "%s-battery" % unique_id,
-        "state_topic": "homeassistant/acurite-tower/%s" % id,
-        "payload_on": "0",  # battery low
-        "payload_off": "1", # battery normal
-        "value_template": "{{ value_json.battery_ok }}",
-        "device": device,
-    }
-    client.publish(topic, json.dumps(data))
-
-door_sensor_known_ids = []
-def door_sensor_handle_data(data):
-    if "id" in data:
-        id = data["id"]
-        if id not in door_sensor_known_ids:
-            door_sensor_register(id)
-            door_sensor_known_ids.append(id)
+            client.publish(self.state_topic(id), payload)
+
+    def register(self, client, id):
+        print("Registering Acurite %s with Home Assistant" % id)
+        Handler.register(self, client, id)
+
+    def build_configs(self, id):
+        configs = []
+        unique_id = "acurite-tower-%s" % id
+        device = {
+            "identifiers": unique_id,
+            "name": "Acurite Thermometer %s" % id,
+            "model": "Acurite-Tower",
+            "manufacturer": "Acurite",
+        }
+        # Temperature
+        topic = "homeassistant/sensor/%s-temperature/config" % unique_id
+        data = {
+            "name": "Temperature",
+            "icon": "mdi:thermometer",
+            "device_class": "temperature",
+            "unique_id": "%s-temperature" % unique_id,
+            "object_id": "%s-temperature" % unique_id,
+            "state_topic": self.state_topic(id),
+            "state_class": "measurement",
+            "unit_of_measurement": "°C",
+            "value_template": "{{ value_json.temperature_C }}",
+            "device": device,
+        }
+        configs.append((topic, json.dumps(data)))
+        # Humidity
+        topic = "homeassistant/sensor/%s-humidity/config" % unique_id
+        data = {
+            "name": "Humidity",
+            "icon": "mdi:cloud-percent",
+            "device_class": "humidity",
+            "unique_id": "%s-humidity" % unique_id,
+            "object_id": "%s-humidity" % unique_id,
+            "state_topic": self.state_topic(id),
+            "state_class": "measurement",
+            "unit_of_measurement": "%",
+            "value_template": "{{ value_json.humidity }}",
+            "device": device,
+        }
+        configs.append((topic, json.dumps(data)))
+        # Battery
+        topic = "homeassistant/binary_sensor/%s-battery/config" % unique_id
+        data = {
+            "name": "Battery",
+            "icon": "mdi:battery-charging",
+            "device_class": "battery",
+            "unique_id": "%s-battery" % unique_id,
+            "object_id": "%s-battery" % unique_id,
+            "state_topic": self.state_topic(id),
+            "payload_on": "0",  # battery low
+            "payload_off": "1", # battery normal
+            "value_template": "{{ value_json.battery_ok }}",
+            "device": device,
+        }
+        configs.append((topic, json.dumps(data)))
+        return configs
+
+@handler("Generic-Remote")
+class DoorSensor(Handler):
+    state_topic_format = "homeassistant/generic-remote/%s"
+    closed_payload = json.dumps({"cmd": 121}).encode()
+
+    def forward(self, client, id, data, payload):
         print("Forwarding data from Door Sensor %s" % id)
-        topic = "homeassistant/generic-remote/%s" % id
-        client.publish(topic, json.dumps(data))
+        client.publish(self.state_topic(id), payload)
+
+    def register_all(self, client):
+        for id in registry.ids(self.model):
+            self.register(client, id)
+            # Send a 'closed' message
+            client.publish(self.state_topic(id), self.closed_payload)
+
+    def register(self, client, id):
+        print("Registering Door Sensor %s with Home Assistant" % id)
+        Handler.register(self, client, id)
 
-def door_sensor_register_all():
-    for id in door_sensor_known_ids:
-        door_sensor_register(id)
-        # Send a 'closed' message
-        topic = "homeassistant/generic-remote/%s" % id
+    def build_configs(self, id):
+        topic = "homeassistant/binary_sensor/door-sensor-%s/config" % id
+        unique_id = "door-sensor-%s" % id
+        device = {
+            "identifiers": unique_id,
+            "name": "Door Sensor %s" % id,
+            "model": "Generic-Remote",
+            "manufacturer": "",
+        }
         data = {
-            "cmd": 121
+            "name": "Door",
+            "device_class": "door",
+            "unique_id": unique_id,
+            "state_topic": self.state_topic(id),
+            "payload_on": 115,
+            "payload_off": 121,
+            "value_template": "{{ value_json.cmd }}",
+            "device": device,
         }
-        client.publish(topic, json.dumps(data))
+        return [(topic, json.dumps(data))]
 
-def door_sensor_register(id):
-    print("Registering Door Sensor %s with Home Assistant" % id)
-    topic = "homeassistant/binary_sensor/door-sensor-%s/config" % id
-    unique_id = "door-sensor-%s" % id
-    device = {
-        "identifiers": unique_id,
-        "name": "Door Sensor %s" % id,
-        "model": "Generic-Remote",
-        "manufacturer": "",
-    }
-    data = {
-        "name": "Door",
-        "device_class": "door",
-        "unique_id": unique_id,
-        "state_topic": "homeassistant/generic-remote/%s" % id,
-        "payload_on": 115,
-        "payload_off": 121,
-        "value_template": "{{ value_json.cmd }}",
-        "device": device,
-    }
-    client.publish(topic, json.dumps(data))
-
-button_known_ids = []
-def button_handle_data(data):
-    if "id" in data:
-        id = data["id"]
-        if id not in button_known_ids:
-            button_register(id)
-            button_known_ids.append(id)
+@handler("Smoke-GS558")
+class Button(Handler):
+    state_topic_format = "homeassistant/button/%s"
+
+    def forward(self, client, id, data, payload):
         data["press"] = True
         print("Forwarding data from Button %s" % id)
-        topic = "homeassistant/button/%s" % id
+        topic = self.state_topic(id)
         client.publish(topic, json.dumps(data))
         data["press"] = False
         client.publish(topic, json.dumps(data))
 
-def button_register_all():
-    for id in button_known_ids:
-        button_register(id)
-
-def button_register(id):
-    print("Registering Button %s with Home Assistant" % id)
-    topic = "homeassistant/binary_sensor/button-%s/config" % id
-    unique_id = "button-%s" % id
-    device = {
-        "identifiers": unique_id,
-        "name": "Button %s" % id,
-        "model": "Button",
-        "manufacturer": "",
-    }
-    data = {
-        "name": "Button",
-        "device_class": None,
-        "unique_id": unique_id,
-        "state_topic": "homeassistant/button/%s" % id,
-        "payload_on": True,
-        "payload_off": False,
-        "value_template": "{{ value_json.press }}",
-        "device": device,
-    }
-    client.publish(topic, json.dumps(data))
-    # send a dummy message saying unpressed
-    topic = "homeassistant/button/%s" % id
-    data = {
-        "model": "Smoke-GS558",
-        "id": "%s" % id,
-        "press": False,
-    }
-    client.publish(topic, json.dumps(data))
+    def register(self, client, id):
+        print("Registering Button %s with Home Assistant" % id)
+        Handler.register(self, client, id)
+        # send a dummy message saying unpressed
+        topic = self.state_topic(id)
+        data = {
+            "model": "Smoke-GS558",
+            "id": "%s" % id,
+            "press": False,
+        }
+        client.publish(topic, json.dumps(data))
+
+    def build_configs(self, id):
+        topic = "homeassistant/binary_sensor/button-%s/config" % id
+        unique_id = "button-%s" % id
+        device = {
+            "identifiers": unique_id,
+            "name": "Button %s" % id,
+            "model": "Button",
+            "manufacturer": "",
+        }
+        data = {
+            "name": "Button",
+            "device_class": None,
+            "unique_id": unique_id,
+            "state_topic": self.state_topic(id),
+            "payload_on": True,
+            "payload_off": False,
+            "value_template": "{{ value_json.press }}",
+            "device": device,
+        }
+        return [(topic, json.dumps(data))]
 
 def main():
+    global intake
+    intake = Intake()
+    intake.start()
+    registrar.start()
     client.on_message = on_message
     client.on_connect = on_connect
-    connected = False
-    while not connected:
-        try:
-            client.connect("192.168.1.9", 1883)
-        except ConnectionRefusedError:
-            print("Unable to connect... retrying...")
-            time.sleep(2)
-        else:
-            connected = True
-    client.loop_forever()
+    # paho retries the first connect and every reconnect itself, backing off
+    # from 1s to 60s, without sleeping in any callback
+    client.reconnect_delay_set(min_delay=1, max_delay=60)
+    client.connect_async("192.168.1.9", 1883)
+    client.loop_forever(retry_first_connection=True)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
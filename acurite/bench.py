@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# Replay/throughput benchmark for the acurite bridge, no broker needed.
+#
+# Feeds either a recorded rtl_433 capture (one JSON message per line, e.g.
+# from `mosquitto_sub -t rtl_433 > capture.jsonl`) or a synthetic stream
+# through acurite.on_message against a fake in-process MQTT client.
+#
+#   ./bench.py                          # synthetic, 50 devices
+#   ./bench.py --devices 200 --messages 100000
+#   ./bench.py capture.jsonl --repeat 10
+#   ./bench.py --queued --workers 2     # through the intake queue
+#   ./bench.py --instances 3 --receivers 2
+#
+# With --queued the latencies are the time the MQTT network thread spends
+# per message, and throughput includes draining the queue.
+#
+# --instances N checks several bridge instances behind a shared subscription:
+# a broker stand-in hands each message to a random instance, and the
+# instances must publish exactly what a single instance would, with every
+# instance forwarding and registering some of the devices.
+#
+# Note replaying a capture compresses time, so repeats of the same reading
+# that were minutes apart on air will fall inside the dedup window here.
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Keep the benchmark from touching the real device registry
+tempdir = tempfile.TemporaryDirectory()
+os.environ["ACURITE_DB"] = os.path.join(tempdir.name, "acurite.db")
+import acurite
+
+MODELS = ["Acurite-Tower", "Generic-Remote", "Smoke-GS558"]
+
+class FakeMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+class FakeClient:
+    def __init__(self):
+        self.published = 0
+        self.published_bytes = 0
+        self.configs = 0
+
+    def publish(self, topic, payload = None, qos = 0, retain = False):
+        self.published = self.published + 1
+        if topic.endswith("/config"):
+            self.configs = self.configs + 1
+        if payload is not None:
+            self.published_bytes = self.published_bytes + len(payload)
+
+    def subscribe(self, topic, qos = 0):
+        pass
+
+class FakeBroker:
+    # Stand-in for a broker with a shared subscription on rtl_433, each
+    # message is delivered to one instance in the group. Random rather than
+    # round robin, which lines up with the bursts and hands every first copy
+    # to the same instance.
+    def __init__(self, instances):
+        self.instances = instances
+        self.clients = [FakeClient() for instance in instances]
+
+    def deliver(self, msg):
+        i = random.randrange(len(self.instances))
+        self.instances[i].on_message(self.clients[i], None, msg)
+
+    def published(self):
+        return sum(client.published for client in self.clients)
+
+def synthetic(devices, messages, burst, register_every):
+    ids = [(random.choice(MODELS), random.randint(0, 0xffff)) for i in range(devices)]
+    out = []
+    n = 0
+    while len(out) < messages:
+        model, id = random.choice(ids)
+        data = {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "model": model,
+            "id": id,
+        }
+        if model == "Acurite-Tower":
+            data["channel"] = "A"
+            data["battery_ok"] = 1
+            data["temperature_C"] = round(random.uniform(-10, 40), 1)
+            data["humidity"] = random.randint(10, 90)
+            data["mic"] = "CHECKSUM"
+        elif model == "Generic-Remote":
+            data["cmd"] = random.choice([115, 121])
+            data["tristate"] = "X0X0X0X0X0X0"
+        payload = json.dumps(data).encode()
+        # Sensors send each reading as a burst of identical packets
+        for i in range(burst):
+            out.append(FakeMessage("rtl_433", payload))
+        n = n + 1
+        if register_every and n % register_every == 0:
+            out.append(FakeMessage("homeassistant/register", b""))
+    return out[:messages]
+
+def load_capture(path):
+    out = []
+    with open(path, "rb") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                out.append(FakeMessage("rtl_433", line))
+    return out
+
+def reset(path, queued, workers, overflow):
+    # Fresh bridge state for every pass
+    acurite.registry = acurite.DeviceRegistry(path)
+    acurite.dedup = acurite.DedupCache()
+    for handler in acurite.handlers.values():
+        handler.checked_ids.clear()
+    acurite.intake = None
+    if queued:
+        acurite.intake = acurite.Intake(workers=workers, overflow=overflow)
+        acurite.intake.start()
+
+def run(messages, db_path, args, trace_memory = False):
+    reset(db_path, args.queued, args.workers, args.overflow)
+    client = FakeClient()
+    latencies = [0] * len(messages)
+    if trace_memory:
+        tracemalloc.start()
+    # The bridge prints on every forward, keep that cost but not the output
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter_ns()
+        for i, msg in enumerate(messages):
+            t = time.perf_counter_ns()
+            acurite.on_message(client, None, msg)
+            latencies[i] = time.perf_counter_ns() - t
+        if acurite.intake is not None:
+            acurite.intake.queue.join()
+        elapsed = time.perf_counter_ns() - start
+    peak = 0
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, latencies, client, peak
+
+# Each instance needs its own copy of the module state, as separate
+# processes would have
+def load_instance(name, db_path, share_group):
+    os.environ["ACURITE_DB"] = db_path
+    os.environ["ACURITE_SHARE_GROUP"] = share_group
+    try:
+        spec = importlib.util.spec_from_file_location(name, acurite.__file__)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        del os.environ["ACURITE_SHARE_GROUP"]
+    return module
+
+def check_instances(messages, count):
+    expected = run(messages, os.path.join(tempdir.name, "single.db"),
+                   argparse.Namespace(queued=False, workers=1, overflow="block"))[2].published
+    db_path = os.path.join(tempdir.name, "shared.db")
+    instances = [load_instance("acurite_%u" % i, db_path, "bench") for i in range(count)]
+    broker = FakeBroker(instances)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter_ns()
+        for msg in messages:
+            broker.deliver(msg)
+        elapsed = time.perf_counter_ns() - start
+    print("instances:          %u" % count)
+    print("messages:           %u" % len(messages))
+    print("throughput:         %.0f msg/s" % (len(messages) / (elapsed / 1e9)))
+    print("published single:   %u" % expected)
+    print("published shared:   %u (%s)" % (broker.published(),
+        ", ".join(str(client.published) for client in broker.clients)))
+    print("configs shared:     %s" % ", ".join(str(client.configs) for client in broker.clients))
+    if broker.published() != expected:
+        print("FAIL: instances duplicated or lost publishes")
+        return 1
+    if not all(client.published and client.configs for client in broker.clients):
+        print("FAIL: not every instance forwarded and registered devices")
+        return 1
+    print("OK")
+    return 0
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark acurite.on_message")
+    parser.add_argument("capture", nargs="?", help="rtl_433 JSON-lines capture to replay")
+    parser.add_argument("--devices", type=int, default=50, help="synthetic device ids")
+    parser.add_argument("--messages", type=int, default=20000, help="synthetic messages")
+    parser.add_argument("--burst", type=int, default=3, help="copies of each synthetic reading")
+    parser.add_argument("--register-every", type=int, default=0,
+                        help="inject a homeassistant/register every N readings")
+    parser.add_argument("--repeat", type=int, default=1, help="times to replay the input")
+    parser.add_argument("--queued", action="store_true", help="go through the intake queue")
+    parser.add_argument("--workers", type=int, default=acurite.INTAKE_WORKERS)
+    parser.add_argument("--overflow", choices=["drop_oldest", "block"], default=acurite.INTAKE_OVERFLOW)
+    parser.add_argument("--instances", type=int, default=0,
+                        help="check N instances sharing a subscription instead")
+    parser.add_argument("--receivers", type=int, default=1,
+                        help="rtl_433 receivers hearing every packet")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if args.capture:
+        messages = load_capture(args.capture)
+    else:
+        messages = synthetic(args.devices, args.messages, args.burst, args.register_every)
+    messages = [msg for msg in messages for i in range(args.receivers)] * args.repeat
+    if not messages:
+        print("Nothing to replay")
+        return 1
+    if args.instances:
+        return check_instances(messages, args.instances)
+
+    elapsed, latencies, client, peak = run(messages, os.path.join(tempdir.name, "timing.db"), args)
+    intake = acurite.intake
+    # Second pass for memory, tracemalloc skews the timings
+    peak = run(messages, os.path.join(tempdir.name, "memory.db"), args, trace_memory=True)[3]
+
+    latencies.sort()
+    print("json backend:       %s" % acurite.json_loads.__module__)
+    print("messages:           %u" % len(messages))
+    print("throughput:         %.0f msg/s" % (len(messages) / (elapsed / 1e9)))
+    print("latency p50:        %.1f us" % (percentile(latencies, 50) / 1e3))
+    print("latency p99:        %.1f us" % (percentile(latencies, 99) / 1e3))
+    print("publishes/message:  %.3f" % (client.published / len(messages)))
+    print("bytes out/message:  %.1f" % (client.published_bytes / len(messages)))
+    print("duplicates dropped: %u" % acurite.dedup.dropped)
+    print("peak memory:        %.1f KiB" % (peak / 1024))
+    if intake is not None:
+        print("intake:             %s" % intake.stats())
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+# Runs the scripts' real read loops and detectors against the simulated
+# hardware in hal.py, so they can be timed on any Linux box.
+#
+#   ./bench.py                         # doorbell, garage door and garden
+#   ./bench.py doorbell --rings 5
+#   ./bench.py doorbell --capture captures/20240101-120000-0000.dbcp
+#   ./bench.py garage --debounce 0.5 --changes 5
+#   ./bench.py garden --sweeps 50
+#
+# Loop rates and latencies are wall clock, CPU is time actually spent
+# running, so the sampler's and poll loop's sleeps don't count.
+import argparse
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+os.environ["HA_SIM"] = "1"
+tempdir = tempfile.TemporaryDirectory()
+os.environ["DOORBELL_CAPTURE_DIR"] = tempdir.name
+import hal
+import doorbell
+import garagedoor
+import garden
+
+class NullClient:
+    availability_topic = None
+
+    def publish(self, topic, payload = None, qos = 0, retain = False, priority = None):
+        pass
+
+    def subscribe(self, topic, qos = 0):
+        pass
+
+# Idle level and noise with a mains-frequency hum on top while ringing
+class Ring:
+    def __init__(self, rings, level = 2.5, noise = 0.002, amplitude = 0.2, frequency = 60.0):
+        self.rings = rings # [(start, end)] in time.monotonic()
+        self.level = level
+        self.noise = noise
+        self.amplitude = amplitude
+        self.frequency = frequency
+
+    def __call__(self, t):
+        value = self.level + random.gauss(0.0, self.noise)
+        for start, end in self.rings:
+            if start <= t < end:
+                value = value + self.amplitude * math.sin(2 * math.pi * self.frequency * t)
+        return value
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+def ms(seconds):
+    return "%.1fms" % (seconds * 1000)
+
+def latencies(label, values):
+    if values:
+        values = sorted(values)
+        print("%-20s%s p50, %s max" % (label + ":", ms(percentile(values, 50)), ms(values[-1])))
+    else:
+        print("%-20snone" % (label + ":"))
+
+def bench_doorbell(args):
+    print("== doorbell")
+    adc = hal.Adafruit_ADS1x15.ADS1115(address=0x48)
+    bell = doorbell.Doorbell(NullClient(), adc, 0)
+    events = [] # (time.monotonic(), state) of every report
+    bell.report = lambda priority = None: events.append((time.monotonic(), bell.state))
+    now = time.monotonic()
+    if args.capture:
+        capture = doorbell.read_capture(args.capture)
+        # Captures are in doorbell.py's units, which scale the ADC counts by
+        # 5.00/32767 rather than by the gain's full scale
+        samples = capture["samples"] * (hal.GAINS[bell.sampler.gain] / 5.00)
+        recording = hal.Recording(samples, capture["data_rate"], loop=False)
+        bell.sampler.data_rate = capture["data_rate"]
+        bell.sampler.period = 1.0 / capture["data_rate"]
+        # Start from the baseline the live detector had, as doorbell_replay.py does
+        bell.baseline.count = bell.baseline.warmup
+        bell.baseline.mean = capture["baseline_mean"]
+        bell.baseline.noise = capture["baseline_noise"]
+        bell.state = not capture["state"]
+        recording.start = now
+        trigger = now + capture["trigger"] / capture["data_rate"]
+        duration = len(capture["samples"]) / capture["data_rate"]
+        # Whichever transition the capture recorded is what we time
+        rings = [(trigger, trigger)] if capture["state"] else [(now, trigger)]
+        hal.signals[(0x48, 0)] = recording
+    else:
+        # Rings start once the baseline has been learned, with quiet between
+        start = now + doorbell.WARMUP_TIME + 1.0
+        rings = [(start + i * (args.ring_time + 2.0), start + i * (args.ring_time + 2.0) + args.ring_time)
+                 for i in range(args.rings)]
+        duration = rings[-1][1] - now + doorbell.RELEASE_TIME + 1.0
+        hal.signals[(0x48, 0)] = Ring(rings, amplitude=args.amplitude)
+
+    iterations = 0
+    cpu = []
+    wall_start = time.monotonic()
+    while time.monotonic() - wall_start < duration:
+        c = time.thread_time()
+        bell.read()
+        cpu.append(time.thread_time() - c)
+        iterations = iterations + 1
+    elapsed = time.monotonic() - wall_start
+
+    # Match each report to the ring it belongs to. A capture only has the
+    # one transition it was saved for, and its trigger is rounded to a block
+    # so detection can come a little before it.
+    time_on = not args.capture or capture["state"]
+    time_off = not args.capture or not capture["state"]
+    on_latency = []
+    off_latency = []
+    false_rings = 0
+    for t, state in events:
+        if state and not any(start - 0.5 <= t <= end + 1.0 for start, end in rings):
+            false_rings = false_rings + 1
+    for start, end in rings:
+        on = [t for t, state in events if state and start - 0.5 <= t <= end + 1.0]
+        off = [t for t, state in events if not state and t >= end]
+        if time_on and on:
+            on_latency.append(on[0] - start)
+        if time_off and off:
+            off_latency.append(off[0] - end)
+    cpu.sort()
+    print("%-20s%.1f blocks/s of %u samples" % ("loop rate:", iterations / elapsed, len(bell.block)))
+    print("%-20s%s" % ("sampler:", bell.sampler.stats()))
+    print("%-20s%.0fus p50, %.0fus p99 (%.1f%% of a core)" % ("cpu/iteration:",
+          percentile(cpu, 50) * 1e6, percentile(cpu, 99) * 1e6, sum(cpu) / elapsed * 100))
+    if time_on:
+        latencies("ring latency", on_latency)
+    if time_off:
+        latencies("release latency", off_latency)
+        print("%-20s%s" % ("release time:", ms(doorbell.RELEASE_TIME)))
+    print("%-20s%u/%u, %u false" % ("detected:", len(on_latency if time_on else off_latency), len(rings), false_rings))
+
+# Door changes with some contact bounce before the sensor settles, returns
+# when each one settled
+def door_script(start_level, changes, spacing):
+    edges = []
+    settled = []
+    level = start_level
+    for i in range(changes):
+        t = 0.5 + i * spacing
+        level = 1 - level
+        for bounce in range(3):
+            edges.append((t + bounce * 0.006, level))
+            edges.append((t + bounce * 0.006 + 0.003, 1 - level))
+        edges.append((t + 0.020, level))
+        settled.append(t + 0.020)
+    return edges, settled
+
+def bench_garage(args, edge):
+    print("== garage door (%s)" % ("edge detect" if edge else "polling"))
+    gpio = hal.gpio
+    garagedoor.DEBOUNCE_TIME = args.debounce
+    gpio.setmode(gpio.BCM)
+    gpio.setup(garagedoor.SENSOR_PIN, gpio.IN, pull_up_down=gpio.PUD_UP)
+    gpio.setup(garagedoor.OPENER_PIN, gpio.OUT)
+    door = garagedoor.GarageDoor(NullClient())
+    door.sensor_state = gpio.input(garagedoor.SENSOR_PIN)
+    door.last_sensor_state = door.sensor_state
+    door.debounced_sensor_state = door.sensor_state
+    reports = []
+    door.report = lambda priority = None: reports.append(time.monotonic())
+    spacing = args.debounce + 1.0
+    edges, settled = door_script(door.sensor_state, args.changes, spacing)
+    duration = settled[-1] + args.debounce + 0.5
+
+    iterations = 0
+    cpu = 0.0
+    if edge:
+        # watch() never returns, time the whole process while it runs
+        threading.Thread(target=door.watch, daemon=True).start()
+        time.sleep(0.1)
+        c = time.process_time()
+        start = time.monotonic()
+        gpio.play(garagedoor.SENSOR_PIN, edges)
+        time.sleep(duration)
+        cpu = time.process_time() - c
+    else:
+        start = time.monotonic()
+        gpio.play(garagedoor.SENSOR_PIN, edges)
+        while time.monotonic() - start < duration:
+            c = time.thread_time()
+            door.read()
+            cpu = cpu + time.thread_time() - c
+            iterations = iterations + 1
+            time.sleep(garagedoor.POLL_PERIOD)
+    elapsed = time.monotonic() - start
+
+    # Time from the sensor settling to the report, past the debounce itself
+    delays = [t - start - s - args.debounce for t, s in zip(reports, settled)]
+    if iterations:
+        print("%-20s%.1f reads/s" % ("loop rate:", iterations / elapsed))
+        print("%-20s%.1fus" % ("cpu/iteration:", cpu / iterations * 1e6))
+    print("%-20s%s over %.1fs (%.2f%% of a core)" % ("cpu:", ms(cpu), elapsed, cpu / elapsed * 100))
+    latencies("report delay", delays)
+    print("%-20s%u/%u" % ("reported:", len(reports), len(settled)))
+
+def bench_garden(args):
+    print("== garden")
+    i2c = hal.busio.I2C(hal.board.SCL, hal.board.SDA)
+    groups = []
+    for address, data_rate, channels in garden.ADCS:
+        adc = hal.ads.ADS1115(i2c, address=address, data_rate=data_rate)
+        groups.append([garden.Sensor(NullClient(), adc, channel) for channel in range(channels)])
+    sensors = [sensor for group in groups for sensor in group]
+    for label, sweep in [("concurrent", garden.Sweep(groups)), ("sequential", garden.Sweep([sensors]))]:
+        times = []
+        c = time.process_time()
+        start = time.monotonic()
+        for i in range(args.sweeps):
+            sweep.run()
+            times.append(sweep.last_time)
+        elapsed = time.monotonic() - start
+        cpu = time.process_time() - c
+        times.sort()
+        print("%-20s%.1f sweeps/s of %u sensors, %s p50, %s max, %.0fus cpu/sweep" % \
+              (label + ":", args.sweeps / elapsed, len(sensors), ms(percentile(times, 50)),
+               ms(times[-1]), cpu / args.sweeps * 1e6))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the device scripts against simulated hardware")
+    parser.add_argument("benches", nargs="*", metavar="doorbell|garage|garden",
+                        default=["doorbell", "garage", "garden"])
+    parser.add_argument("--rings", type=int, default=3, help="synthetic doorbell rings")
+    parser.add_argument("--ring-time", type=float, default=1.0, help="seconds each ring lasts")
+    parser.add_argument("--amplitude", type=float, default=0.2, help="volts of ring hum")
+    parser.add_argument("--capture", help="replay a doorbell capture instead")
+    parser.add_argument("--debounce", type=float, default=garagedoor.DEBOUNCE_TIME)
+    parser.add_argument("--changes", type=int, default=2, help="garage door opens/closes")
+    parser.add_argument("--sweeps", type=int, default=20, help="garden sensor sweeps")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    for bench in args.benches:
+        if bench not in ["doorbell", "garage", "garden"]:
+            parser.error("unknown benchmark %s" % bench)
+    random.seed(args.seed)
+    if "doorbell" in args.benches:
+        bench_doorbell(args)
+    if "garden" in args.benches:
+        bench_garden(args)
+    if "garage" in args.benches:
+        bench_garage(args, edge=False)
+        # Last, its watch thread keeps running
+        bench_garage(args, edge=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+# MQTT connection shared by the scripts. Connects and reconnects on paho's
+# network thread (loop_start) with jittered exponential backoff, so no
+# callback ever sleeps waiting for the broker. With that thread running,
+# publishing from any other thread only queues the packet and wakes it to do
+# the writing. Anything published while the broker is away is kept in a
+# bounded queue and sent as soon as the connection is back.
+#
+#   connection = Connection("mqtt_garagedoor_%u" % os.getpid())
+#   connection.client.on_message = on_message
+#   connection.subscribe("homeassistant/register")
+#   connection.start()
+#   connection.publish(topic, payload, priority=EVENT)
+#
+# With an availability topic, "online" is published there (retained) on every
+# connect, and the broker publishes "offline" as our last will if we drop off.
+# Discovery configs point Home Assistant at it, so state can be published
+# retained and only when it changes.
+#
+# Subscriptions are remade on every connect. publish() takes the same
+# arguments as paho's, plus a priority:
+#   EVENT   state changes, kept in order and dropped last
+#   REPORT  periodic state, only the latest one per topic is kept
+
+import paho.mqtt.client as mqtt
+import random
+import threading
+from collections import OrderedDict
+
+BROKER_HOST = "192.168.1.9"
+BROKER_PORT = 1883
+KEEPALIVE = 60 # seconds
+RECONNECT_MIN = 1.0 # seconds before the first retry
+RECONNECT_MAX = 60.0 # seconds, the backoff doubles up to this
+OFFLINE_QUEUE_SIZE = 200 # messages held while disconnected
+
+EVENT = 0
+REPORT = 1
+
+class Connection:
+    def __init__(self, client_id, availability_topic = None, host = BROKER_HOST, port = BROKER_PORT,
+                 queue_size = OFFLINE_QUEUE_SIZE):
+        self.client = mqtt.Client(client_id)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_connect_fail = self.on_connect_fail
+        self.availability_topic = availability_topic
+        if availability_topic is not None:
+            self.client.will_set(availability_topic, "offline", retain=True)
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        # Offline messages in the order they were published. Reports are
+        # keyed by topic so a newer one replaces the older, events by a
+        # sequence number so every one is kept.
+        self.pending = OrderedDict()
+        self.sequence = 0
+        self.subscriptions = []
+        self.connect_hooks = []
+        self.connected = False
+        self.stopped = False
+        self.attempts = 0 # failed connects since the last success
+        self.connects = 0
+        self.queued = 0
+        self.dropped = 0
+        self.replayed = 0
+
+    def start(self):
+        self.client.connect_async(self.host, self.port, KEEPALIVE)
+        self.client.loop_start()
+
+    def stop(self):
+        # A clean disconnect doesn't trigger the will, say so ourselves
+        if self.connected and self.availability_topic is not None:
+            try:
+                self.client.publish(self.availability_topic, "offline", retain=True).wait_for_publish(1.0)
+            except:
+                pass
+        self.stopped = True
+        try:
+            self.client.disconnect()
+            self.client.loop_stop()
+        except:
+            pass
+
+    def subscribe(self, topic):
+        with self.lock:
+            if topic in self.subscriptions:
+                return
+            self.subscriptions.append(topic)
+            if self.connected:
+                self.client.subscribe(topic)
+
+    # function(connection) after every successful connect, on the network thread
+    def on_connected(self, function):
+        self.connect_hooks.append(function)
+
+    def publish(self, topic, payload = None, qos = 0, retain = False, priority = REPORT):
+        with self.lock:
+            if self.connected:
+                if self.client.publish(topic, payload, qos, retain).rc == mqtt.MQTT_ERR_SUCCESS:
+                    return
+            self.enqueue(topic, payload, qos, retain, priority)
+
+    # Call with the lock held
+    def enqueue(self, topic, payload, qos, retain, priority):
+        if priority == REPORT:
+            key = topic
+            self.pending.pop(key, None)
+        else:
+            key = self.sequence
+            self.sequence = self.sequence + 1
+        if len(self.pending) >= self.queue_size:
+            # Make room by dropping the oldest report, or failing that the
+            # oldest event. A report never pushes out an event.
+            oldest = next((k for k, message in self.pending.items() if message[4] == REPORT), None)
+            if oldest is None and priority == REPORT:
+                self.dropped = self.dropped + 1
+                return
+            if oldest is None:
+                self.pending.popitem(last=False)
+            else:
+                del self.pending[oldest]
+            self.dropped = self.dropped + 1
+        self.pending[key] = (topic, payload, qos, retain, priority)
+        self.queued = self.queued + 1
+
+    def stats(self):
+        return "%u reconnects, %u queued offline, %u replayed, %u dropped, %u waiting" % \
+               (max(0, self.connects - 1), self.queued, self.replayed, self.dropped, len(self.pending))
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            print("Error connecting (%i)" % rc, flush=True)
+            return
+        with self.lock:
+            self.connected = True
+            self.connects = self.connects + 1
+            self.attempts = 0
+            if self.availability_topic is not None:
+                client.publish(self.availability_topic, "online", retain=True)
+            for topic in self.subscriptions:
+                client.subscribe(topic)
+            # Send everything that piled up in one go, in order, before
+            # anything new can be published
+            pending = list(self.pending.values())
+            self.pending.clear()
+            for i, (topic, payload, qos, retain, priority) in enumerate(pending):
+                if client.publish(topic, payload, qos, retain).rc != mqtt.MQTT_ERR_SUCCESS:
+                    # Lost the connection again, keep the rest for next time
+                    for message in pending[i:]:
+                        self.enqueue(*message)
+                    break
+                self.replayed = self.replayed + 1
+        print("Connected, sent %u queued messages (%s)" % (len(pending), self.stats()), flush=True)
+        for function in self.connect_hooks:
+            try:
+                function(self)
+            except Exception as e:
+                print("Connect hook failed: %s" % e, flush=True)
+
+    def on_disconnect(self, client, userdata, rc):
+        with self.lock:
+            self.connected = False
+        if not self.stopped:
+            print("Disconnected (%i), reconnecting in %.1fs..." % (rc, self.backoff()), flush=True)
+
+    def on_connect_fail(self, client, userdata):
+        print("Unable to connect to %s:%u, retrying in %.1fs..." % (self.host, self.port, self.backoff()), flush=True)
+
+    # Doubles the wait after every failure, with jitter so devices that lost
+    # the broker together don't all come back at the same moment. paho does
+    # the waiting, it's handed this one delay for its next retry.
+    def backoff(self):
+        delay = min(RECONNECT_MAX, RECONNECT_MIN * 2 ** self.attempts)
+        self.attempts = self.attempts + 1
+        delay = random.uniform(delay / 2, delay)
+        self.client.reconnect_delay_set(min_delay=delay, max_delay=delay)
+        return delay
@@ -0,0 +1,53 @@
+# Home Assistant MQTT discovery for the scripts. An Entity works out its
+# topics and serializes its discovery config once, when it's created, so
+# registering is a single publish of ready-made bytes. State payloads are
+# formatted through templates made up front with template().
+
+import json
+
+PREFIX = "homeassistant"
+
+def normalize(name):
+    return name.lower().replace(" ", "_")
+
+def device(identifiers, name, model = None, manufacturer = ""):
+    return {
+        "identifiers": identifiers,
+        "name": name,
+        "model": model or name,
+        "manufacturer": manufacturer,
+    }
+
+# JSON object template for % formatting from (key, format) pairs, e.g.
+#   template(("state", '"%s"'), ("rms", "%.3f")) == '{"state":"%s","rms":%.3f}'
+def template(*fields):
+    return "{" + ",".join('"%s":%s' % (key, format) for key, format in fields) + "}"
+
+class Entity:
+    # config is the rest of the discovery config (icon, value_template, ...)
+    def __init__(self, component, name, device, state_topic, availability_topic = None,
+                 unique_id = None, command_topic = None, **config):
+        self.name = name
+        self.id = normalize(name)
+        self.topic = "%s/%s/%s/config" % (PREFIX, component, self.id)
+        self.state_topic = state_topic
+        self.command_topic = command_topic
+        data = {
+            "name": name,
+            "unique_id": unique_id or self.id,
+            "state_topic": state_topic,
+        }
+        if command_topic is not None:
+            data["command_topic"] = command_topic
+        if availability_topic is not None:
+            data["availability_topic"] = availability_topic
+        data.update(config)
+        data["device"] = device
+        self.config = json.dumps(data).encode()
+
+    def register(self, client, retain = False):
+        print("Registering %s with Home Assistant..." % self.id, flush=True)
+        try:
+            client.publish(self.topic, self.config, retain=retain)
+        except:
+            pass
@@ -1,176 +1,407 @@
 #!/usr/bin/python3
 
-import paho.mqtt.client as mqtt
 import time
-import json
 import os
-from threading import Timer
-import schedule
-import Adafruit_ADS1x15 as ads
-import setproctitle
+import queue
+import struct
+from array import array
+from threading import Thread
+import numpy as np
+from connection import Connection, EVENT, REPORT
+from scheduler import Scheduler, LOW
+import discovery
+import notify
 
-# https://stackoverflow.com/a/48741004
-class RepeatTimer(Timer):
-    def run(self):
-        while not self.finished.wait(self.interval):
-            self.function(*self.args, **self.kwargs)
+# ADS1115 data rate in continuous mode, one of 8, 16, 32, 64, 128, 250, 475, 860
+SAMPLE_RATE = 860 # samples per second
+BLOCK_SIZE = 64 # samples handed to the detector at a time, several mains cycles
+RELEASE_TIME = 0.35 # seconds the signal must be quiet before a ring ends
+RELEASE_FACTOR = 0.6 # fraction of the ring threshold the signal must drop under to be quiet
+STATS_PERIOD = 5 # minutes between sample rate reports
+# After a failed ADC read, wait before retrying, doubling up to the max while
+# it keeps failing. Kept under the supervisor's watchdog timeout.
+RETRY_MIN = 0.1 # seconds
+RETRY_MAX = 5.0 # seconds
+# State is published retained whenever it changes, and re-sent this often in
+# case the broker lost it. Home Assistant tracks whether we're up through
+# AVAILABILITY_TOPIC instead.
+HEARTBEAT_PERIOD = 3600 # seconds
+AVAILABILITY_TOPIC = "homeassistant/doorbell/availability"
+STATE_TEMPLATE = discovery.template(("state", '"%s"'), ("voltage", "%.3f"), ("rms", "%.3f"))
+# The baseline is learned from the first WARMUP_TIME seconds of samples, then
+# tracked as an exponentially weighted mean/noise over BASELINE_TIME
+WARMUP_TIME = 2.0 # seconds
+BASELINE_TIME = 600.0 # seconds
+DETECTION_FACTOR = 4.0 # block RMS, in idle noise deviations, that counts as a ring
+MIN_RMS = 0.003 # volts, so ADC quantization alone can't trigger a ring
+MAX_RING_TIME = 30.0 # seconds, a "ring" longer than this means the baseline moved
+# Waveform around every ring start/end is saved for tuning the detector,
+# see doorbell_replay.py
+CAPTURE_PRE = 2.0 # seconds before the transition
+CAPTURE_POST = 2.0 # seconds after the transition
+CAPTURE_DIR = os.environ.get("DOORBELL_CAPTURE_DIR",
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), "captures"))
+CAPTURE_KEEP = 50 # files, oldest are deleted
+CAPTURE_MQTT = False # also publish the latest capture, retained
+# magic, version, state after the transition, wall time, data rate,
+# baseline mean, baseline noise, trigger offset (samples), sample count
+CAPTURE_HEADER = struct.Struct("<4sBB2xdfffII")
+CAPTURE_MAGIC = b"DBCP"
 
-class Doorbell:
-    def __init__(self, client, adc, channel = 0, name = "Doorbell"):
-        self.client = client
+# Keeps the ADC in continuous-conversion mode and reads it at the data rate,
+# so there's no per-sample I2C setup and samples are evenly spaced
+class Sampler:
+    def __init__(self, adc, channel = 0, gain = 1, data_rate = SAMPLE_RATE, block_size = BLOCK_SIZE):
         self.adc = adc
         self.channel = channel
-        self.value = 0
+        self.gain = gain
+        self.data_rate = data_rate
+        self.period = 1.0 / data_rate
+        self.block = array('f', [0.0] * block_size)
+        self.running = False
+        self.next_sample = 0.0
+        self.reset_stats()
+
+    def start(self):
+        self.adc.start_adc(self.channel, gain=self.gain, data_rate=self.data_rate)
+        self.running = True
+        self.next_sample = time.monotonic()
+        self.last_read = 0.0
+
+    def stop(self):
+        self.running = False
+        try:
+            self.adc.stop_adc()
+        except:
+            pass
+
+    # Fills and returns block, by default the sampler's own reused buffer
+    def read_block(self, block = None):
+        if not self.running:
+            self.start()
+        if block is None:
+            block = self.block
+        for i in range(len(block)):
+            now = time.monotonic()
+            if self.next_sample > now:
+                time.sleep(self.next_sample - now)
+                now = time.monotonic()
+            block[i] = self.adc.get_last_result() * (5.00 / 32767)
+            # Fell more than a sample behind, don't try to catch up
+            if now - self.next_sample > self.period:
+                self.next_sample = now
+                self.overruns = self.overruns + 1
+            self.next_sample = self.next_sample + self.period
+            if self.last_read:
+                interval = now - self.last_read
+                self.intervals = self.intervals + 1
+                delta = interval - self.interval_mean
+                self.interval_mean = self.interval_mean + delta / self.intervals
+                self.interval_m2 = self.interval_m2 + delta * (interval - self.interval_mean)
+            self.last_read = now
+        self.samples = self.samples + len(block)
+        return block
+
+    def reset_stats(self):
+        self.stats_start = time.monotonic()
+        self.samples = 0
+        self.overruns = 0
+        self.intervals = 0
+        self.interval_mean = 0.0
+        self.interval_m2 = 0.0
+
+    def stats(self):
+        elapsed = time.monotonic() - self.stats_start
+        rate = self.samples / elapsed if elapsed > 0 else 0
+        jitter = (self.interval_m2 / self.intervals) ** 0.5 if self.intervals > 1 else 0
+        return "Sampling at %.1f SPS (target %u), jitter %.3fms, %u overruns" % \
+               (rate, self.data_rate, jitter * 1000, self.overruns)
+
+    def report_stats(self):
+        print(self.stats())
+        self.reset_stats()
+
+# Always holds the last few seconds of samples. The sampler reads straight
+# into its slots, so keeping the history costs nothing on the hot path; only
+# the window around a transition is copied out, once it has been recorded.
+class CaptureBuffer:
+    def __init__(self, data_rate, block_size, pre = CAPTURE_PRE, post = CAPTURE_POST):
+        self.data_rate = data_rate
+        self.pre = int(pre * data_rate)
+        self.post = int(post * data_rate)
+        # One spare block so the oldest pre-trigger samples aren't overwritten
+        # while the post-trigger window is still filling
+        count = -(-(self.pre + self.post) // block_size) + 1
+        self.buffer = array('f', bytes(4 * count * block_size))
+        view = memoryview(self.buffer)
+        self.slots = [view[i * block_size:(i + 1) * block_size] for i in range(count)]
+        self.arrays = [np.frombuffer(slot, dtype=np.float32) for slot in self.slots]
+        self.slot = 0
+        self.written = 0 # samples in completed slots, ever
+        self.pending = [] # (trigger sample, state, baseline mean, baseline noise)
+        self.queue = queue.Queue()
+        self.client = None
+        self.topic = None
+        Thread(target=self.writer, name="capture", daemon=True).start()
+
+    # Called from the detector while the current slot is being processed
+    def trigger(self, state, baseline):
+        trigger = self.written + len(self.slots[self.slot])
+        self.pending.append((trigger, state, baseline.mean, baseline.noise))
+
+    def advance(self):
+        self.written = self.written + len(self.slots[self.slot])
+        self.slot = (self.slot + 1) % len(self.slots)
+        while self.pending and self.written >= self.pending[0][0] + self.post:
+            self.dump(*self.pending.pop(0))
+
+    def dump(self, trigger, state, mean, noise):
+        size = len(self.buffer)
+        start = max(trigger - self.pre, self.written - size, 0)
+        end = trigger + self.post
+        first = start % size
+        last = first + (end - start)
+        if last <= size:
+            samples = self.buffer[first:last].tobytes()
+        else:
+            samples = self.buffer[first:].tobytes() + self.buffer[:last - size].tobytes()
+        header = CAPTURE_HEADER.pack(CAPTURE_MAGIC, 1, state, time.time(), self.data_rate,
+                                     mean, noise, trigger - start, end - start)
+        self.queue.put(header + samples)
+
+    # Disk and network I/O happen here, off the sampling thread
+    def writer(self):
+        while True:
+            capture = self.queue.get()
+            name = time.strftime("%Y%m%d-%H%M%S") + ("-%04u.dbcp" % (time.time() % 1 * 10000))
+            try:
+                os.makedirs(CAPTURE_DIR, exist_ok=True)
+                with open(os.path.join(CAPTURE_DIR, name), "wb") as f:
+                    f.write(capture)
+                files = sorted(f for f in os.listdir(CAPTURE_DIR) if f.endswith(".dbcp"))
+                for old in files[:-CAPTURE_KEEP]:
+                    os.remove(os.path.join(CAPTURE_DIR, old))
+            except OSError as e:
+                print("Unable to save capture: %s" % e)
+            if self.client is not None and self.topic is not None:
+                try:
+                    self.client.publish(self.topic, capture, retain=True)
+                except:
+                    pass
+
+def read_capture(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, state, timestamp, data_rate, mean, noise, trigger, count = \
+        CAPTURE_HEADER.unpack_from(data)
+    if magic != CAPTURE_MAGIC or version != 1:
+        raise ValueError("%s is not a doorbell capture" % path)
+    samples = np.frombuffer(data, dtype="<f4", count=count, offset=CAPTURE_HEADER.size)
+    return {
+        "state": bool(state),
+        "time": timestamp,
+        "data_rate": data_rate,
+        "baseline_mean": mean,
+        "baseline_noise": noise,
+        "trigger": trigger,
+        "samples": samples,
+    }
+
+# Running DC level and noise power of the idle signal, updated block by block
+class RunningBaseline:
+    def __init__(self, warmup_blocks, time_constant_blocks):
+        self.warmup = warmup_blocks
+        self.alpha = 1.0 / time_constant_blocks
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self.noise = 0.0 # variance of the samples around the mean
+
+    def ready(self):
+        return self.count >= self.warmup
+
+    def update(self, mean, variance):
+        if self.count < self.warmup:
+            # Plain average over the warm-up
+            self.count = self.count + 1
+            self.mean = self.mean + (mean - self.mean) / self.count
+            self.noise = self.noise + (variance - self.noise) / self.count
+            if self.count == self.warmup:
+                print("Baseline voltage reading: %sV +/- %sV" % \
+                      (round(self.mean, 3), round(self.deviation(), 4)))
+        else:
+            self.mean = self.mean + self.alpha * (mean - self.mean)
+            self.noise = self.noise + self.alpha * (variance - self.noise)
+
+    def deviation(self):
+        return self.noise ** 0.5
+
+class Doorbell:
+    def __init__(self, client, adc, channel = 0, name = "Doorbell", capture = True):
+        self.client = client
+        self.sampler = Sampler(adc, channel)
+        # numpy view of the sampler's block buffer, no copying
+        self.block = np.frombuffer(self.sampler.block, dtype=np.float32)
+        self.capture = None
+        if capture:
+            self.capture = CaptureBuffer(self.sampler.data_rate, len(self.block))
+        blocks_per_second = self.sampler.data_rate / len(self.block)
+        self.baseline = RunningBaseline(max(1, int(WARMUP_TIME * blocks_per_second)),
+                                        BASELINE_TIME * blocks_per_second)
         self.voltage = 0.000
-        self.baseline = 0.000
-        self.variance = 0.000
+        self.rms = 0.000
         self.state = False
-        self.last_state = False
         self.name = name
-        self.count = 0
+        self.entity = discovery.Entity("binary_sensor", name,
+            discovery.device(discovery.normalize(name), "Doorbell"),
+            "homeassistant/doorbell/%s" % discovery.normalize(name),
+            client.availability_topic,
+            unique_id="doorbell",
+            icon="mdi:doorbell",
+            value_template="{{ value_json.state }}")
+        # Time is kept in samples read, so detection doesn't depend on how
+        # promptly blocks are processed
+        self.time = 0.0
+        self.ring_start = 0.0
+        self.quiet_since = None
+        self.retry_delay = 0.0 # seconds, while the ADC is failing
     
     def read(self):
+        block = self.block
         try:
-            self.value = self.adc.read_adc(0, gain=1)
-        except:
-            self.value = 0
+            if self.capture is not None:
+                # Read straight into the capture history
+                self.sampler.read_block(self.capture.slots[self.capture.slot])
+                block = self.capture.arrays[self.capture.slot]
+            else:
+                self.sampler.read_block()
+        except Exception as e:
+            # Restart conversions on the next read
+            self.sampler.stop()
             self.voltage = 0
-            self.state = False
-            self.last_state = False
+            if self.state:
+                self.state = False
+                self.report(EVENT)
+            # Back off rather than hammer a dead ADC and the I2C bus
+            if not self.retry_delay:
+                print("ADC read failed (%s), retrying..." % e)
+            self.retry_delay = min(RETRY_MAX, max(RETRY_MIN, self.retry_delay * 2))
+            time.sleep(self.retry_delay)
             return
-        self.voltage = self.value * (5.00 / 32767)
-        #print("%s" % round(self.voltage, 3))
-        if self.baseline != 0:
-            detection_factor = 5.5
-            state = (self.voltage > (self.baseline + (self.variance * detection_factor))) or \
-                    (self.voltage < (self.baseline - (self.variance * detection_factor)))
-            #print("%0.3fV - %s" % (self.voltage, "RING" if state else "----"))
-            # Wait until signal stabilizes before signaling a on->off transition
-            if not state and self.last_state:
-                self.count = self.count + 1
-                if self.count > 20:
-                    self.state = False
-                    self.last_state = False
-                    self.count = 0
-                    self.report()
+        if self.retry_delay:
+            print("ADC read recovered")
+            self.retry_delay = 0.0
+        self.detect(block)
+        if self.capture is not None:
+            self.capture.advance()
+
+    def detect(self, block):
+        self.time = self.time + len(block) / self.sampler.data_rate
+        self.voltage = float(block[-1])
+        mean = float(block.mean())
+        if not self.baseline.ready():
+            self.baseline.update(mean, float(block.var()))
+            return
+        # RMS around the idle level, a single spike barely moves it
+        self.rms = float(np.sqrt(np.mean(np.square(block - self.baseline.mean))))
+        threshold = max(self.baseline.deviation() * DETECTION_FACTOR, MIN_RMS)
+        #print("%0.3fV RMS - %s" % (self.rms, "RING" if self.rms > threshold else "----"))
+        if not self.state:
             # Immediately signal a off->on transition
-            if state and not self.last_state:
+            if self.rms > threshold:
                 self.state = True
-                self.last_state = True
+                self.ring_start = self.time
+                self.quiet_since = None
                 print("Ring!!!")
-                self.report()
-            # Otherwise just update state
-            if not state and not self.last_state:
-                self.state = False
-                self.last_state = False
-            if state and self.last_state:
-                self.state = True
-                self.last_state = True
+                self.report(EVENT)
+                if self.capture is not None:
+                    self.capture.trigger(True, self.baseline)
+            else:
+                # Only idle blocks go into the baseline
+                self.baseline.update(mean, float(block.var()))
         else:
-            self.state = False
-            self.last_state = False
-    
-    def get_baseline(self, sampleTime = 10.0, numSamples = 100):
-        print("Gathering baseline...")
-        samples = [0] * numSamples
-        for i in range(numSamples):
-            self.read()
-            samples[i] = self.voltage
-            time.sleep(sampleTime / numSamples)
-        self.baseline = sum(samples) / len(samples)
-        self.variance = max(abs(self.baseline - max(samples)), \
-                            abs(self.baseline - min(samples)))
-        print("Baseline voltage reading: %sV +/- %sV" % \
-              (round(self.baseline, 3), round(self.variance, 3)))
+            # Wait until signal has been quiet for a while before signaling a on->off transition
+            if self.rms < threshold * RELEASE_FACTOR:
+                if self.quiet_since is None:
+                    self.quiet_since = self.time
+                elif self.time - self.quiet_since >= RELEASE_TIME:
+                    self.state = False
+                    self.report(EVENT)
+                    if self.capture is not None:
+                        self.capture.trigger(False, self.baseline)
+            else:
+                self.quiet_since = None
+            # Nobody holds the button this long, relearn the baseline
+            if self.state and self.time - self.ring_start > MAX_RING_TIME:
+                print("Ring too long, relearning baseline...")
+                self.baseline.reset()
+                self.state = False
+                self.report(EVENT)
           
     def register(self):
-        name_normalized = self.name.lower().replace(" ", "_")
-        print("Registering %s with Home Assistant..." % name_normalized)
-        device = {
-            "identifiers": name_normalized,
-            "name": "Doorbell",
-            "model": "Doorbell",
-            "manufacturer": "",
-        }
-        topic = "homeassistant/binary_sensor/%s/config" % name_normalized
-        data = {
-            "name": self.name, 
-            "icon": "mdi:doorbell",
-            "unique_id": "doorbell",
-            "state_topic": "homeassistant/doorbell/%s" % name_normalized,
-            "value_template": "{{ value_json.state }}",
-            "device": device,
-        }
-        try:
-            self.client.publish(topic, json.dumps(data), retain=True)
-        except:
-            pass
-        return
+        self.entity.register(self.client, retain=True)
         
-    def report(self):
-        name_normalized = self.name.lower().replace(" ", "_")
-        #print("%s: %s" % (name_normalized, self.state))
-        topic = "homeassistant/doorbell/%s" % name_normalized
-        data = {
-            "state": "ON" if self.state else "OFF",
-            "voltage": round(self.voltage, 3)
-        }
+    def report(self, priority = REPORT):
+        payload = STATE_TEMPLATE % ("ON" if self.state else "OFF", self.voltage, self.rms)
         try:
-            self.client.publish(topic, json.dumps(data))
+            self.client.publish(self.entity.state_topic, payload, retain=True, priority=priority)
         except:
             pass
-        return
         
     def on_message(self, client, userdata, msg):
         if msg.topic == "homeassistant/register":
             self.register()
-            
-    def on_connect(self, client, userdata, flags, rc):
-        if rc == 0:
-            print("Connected")
-            client.subscribe("homeassistant/register")
-        else:
-            print("Error connecting (%i)" % rc)
-        
-    def try_connect(self, client):
-        connected = False
-        while not connected:
-            try:
-                client.connect("192.168.1.9", 1883)
-            except:
-                print("Unable to connect... retrying...")
-                time.sleep(2)
-            else:
-                connected = True
-
-    def on_disconnect(self, client, userdata,  rc):
-        self.try_connect(client)
         
-def main():
-    setproctitle.setproctitle('doorbell')
-    client = mqtt.Client("mqtt_garden_%u" % os.getpid())
+# Sets up the ADC and the doorbell, registers it and starts reporting, for
+# both main() and setup(). every is the host's Scheduler.every or
+# Runtime.every. The host keeps calling read() after this.
+def start(client, every):
+    # Hardware libraries are only needed here, so the detector can be used
+    # off the Pi (see doorbell_replay.py)
+    from hal import Adafruit_ADS1x15 as ads
     adc = ads.ADS1115(address=0x48)
-    doorbell = Doorbell(client, adc, 0) 
-    client.on_message = doorbell.on_message
-    client.on_connect = doorbell.on_connect
-    client.on_disconnect = doorbell.on_disconnect
-    doorbell.try_connect(client)
-    client.loop_start()
+    doorbell = Doorbell(client, adc, 0)
+    if CAPTURE_MQTT:
+        doorbell.capture.client = client
+        doorbell.capture.topic = doorbell.entity.state_topic + "/capture"
     doorbell.register()
-    doorbell.get_baseline()
-    # Use schedule to re-acquire baseline nightly
-    schedule.every().day.at("04:00").do(doorbell.get_baseline)
-    # Use the repeating timer to send the reports every 15 seconds
-    timer = RepeatTimer(15, doorbell.report)
-    timer.daemon = True
-    timer.start()
-    # Take readings as often as possible
+    client.on_connected(lambda connection: doorbell.report())
+    every(HEARTBEAT_PERIOD, doorbell.report, name="doorbell report")
+    every(STATS_PERIOD * 60, doorbell.sampler.report_stats, name="doorbell stats", priority=LOW)
+    # The baseline is learned from the readings as they go
     doorbell.read()
     doorbell.report()
-    while(1):
-        doorbell.read()
-        schedule.run_pending()
-        time.sleep(0.01)
+    return doorbell
+
+def main():
+    import setproctitle
+    setproctitle.setproctitle('doorbell')
+    connection = Connection("mqtt_garden_%u" % os.getpid(), AVAILABILITY_TOPIC)
+    connection.subscribe("homeassistant/register")
+    scheduler = Scheduler()
+    doorbell = start(connection, scheduler.every)
+    connection.client.on_message = doorbell.on_message
+    # Connects in the background, anything published before then is queued
+    connection.start()
+    # Take readings continuously, the sampler paces itself to the data rate.
+    # Everything else runs between blocks, on the same thread.
+    scheduler.continuous(doorbell.read, name="sample")
+    scheduler.every(STATS_PERIOD * 60, scheduler.report_stats, name="stats", priority=LOW)
+    notify.heartbeat(scheduler)
+    notify.ready()
+    scheduler.run()
+
+# Entry point for runtime.py
+def setup(runtime):
+    doorbell = start(runtime.client, runtime.every)
+    runtime.subscribe("homeassistant/register", doorbell.on_message)
+    # Sampling paces itself on the ADC, so it keeps a thread of its own
+    def sample():
+        while True:
+            doorbell.read()
+    runtime.thread(sample)
 
 if __name__ == "__main__":
     main()
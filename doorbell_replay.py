@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+# Replays the waveform captures doorbell.py saves around every ring through
+# the ring detector, so its settings can be tuned from real data off the Pi.
+#
+#   ./doorbell_replay.py captures/*.dbcp
+#   ./doorbell_replay.py --detection-factor 3 --release-time 0.5 captures/*.dbcp
+
+import argparse
+import time
+import doorbell
+
+class NullClient:
+    availability_topic = None
+
+    def publish(self, topic, payload = None, qos = 0, retain = False, priority = None):
+        pass
+
+def replay(path):
+    capture = doorbell.read_capture(path)
+    bell = doorbell.Doorbell(NullClient(), None, capture=False)
+    bell.sampler.data_rate = capture["data_rate"]
+    # Start from the baseline and state the live detector had
+    bell.baseline.count = bell.baseline.warmup
+    bell.baseline.mean = capture["baseline_mean"]
+    bell.baseline.noise = capture["baseline_noise"]
+    bell.state = not capture["state"]
+    transitions = []
+    bell.report = lambda priority = None: transitions.append((bell.time, bell.state))
+    samples = capture["samples"]
+    size = len(bell.block)
+    for i in range(0, len(samples) - size + 1, size):
+        bell.detect(samples[i:i + size])
+    trigger = capture["trigger"] / capture["data_rate"]
+    return capture, [(t - trigger, state) for t, state in transitions]
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay doorbell captures through the detector")
+    parser.add_argument("captures", nargs="+")
+    parser.add_argument("--detection-factor", type=float, default=doorbell.DETECTION_FACTOR)
+    parser.add_argument("--min-rms", type=float, default=doorbell.MIN_RMS)
+    parser.add_argument("--release-factor", type=float, default=doorbell.RELEASE_FACTOR)
+    parser.add_argument("--release-time", type=float, default=doorbell.RELEASE_TIME)
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="seconds a replayed transition may be from the recorded one")
+    args = parser.parse_args()
+    doorbell.DETECTION_FACTOR = args.detection_factor
+    doorbell.MIN_RMS = args.min_rms
+    doorbell.RELEASE_FACTOR = args.release_factor
+    doorbell.RELEASE_TIME = args.release_time
+
+    matched = 0
+    for path in args.captures:
+        try:
+            capture, transitions = replay(path)
+        except (OSError, ValueError) as e:
+            print("%s: %s" % (path, e))
+            continue
+        expected = "ON" if capture["state"] else "OFF"
+        replayed = ", ".join("%s at %+.3fs" % ("ON" if state else "OFF", t) for t, state in transitions)
+        print("%s (%s): recorded %s at +0.000s, replay: %s" % \
+              (path, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(capture["time"])),
+               expected, replayed or "no change"))
+        if any(state == capture["state"] and abs(t) <= args.tolerance for t, state in transitions):
+            matched = matched + 1
+    print("%u/%u captures reproduce the recorded transition" % (matched, len(args.captures)))
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,30 @@
 #!/usr/bin/python3
 
-import paho.mqtt.client as mqtt
 import time
-import json
 import os
 from enum import Enum
-import RPi.GPIO as gpio
-from threading import Timer
+from collections import deque
+from hal import gpio
+from threading import Thread, Condition
 import setproctitle
+from connection import Connection, EVENT, REPORT
+from scheduler import Scheduler, HIGH
+import discovery
+import notify
 
 SENSOR_PIN = 12
 OPENER_PIN = 26
+DEBOUNCE_TIME = 2.0 # seconds the sensor must be stable before a change is reported
+# Wait for GPIO edge interrupts instead of polling the sensor every POLL_PERIOD
+USE_EDGE_DETECT = True
+POLL_PERIOD = 0.05 # seconds
+PULSE_TIME = 0.100 # seconds the opener relay is held
+MIN_PULSE_GAP = 1.0 # seconds between relay pulses, so the opener sees each one
+# The door state is retained and only sent when it changes, plus once per
+# heartbeat. The broker marks us offline on AVAILABILITY_TOPIC if we die.
+HEARTBEAT_PERIOD = 3600 # seconds
+AVAILABILITY_TOPIC = "homeassistant/garage_door/availability"
+TOPICS = ["homeassistant/register", "homeassistant/garage_door/#"]
 
 class State(Enum):
     UNKNOWN = 0
@@ -19,11 +33,49 @@ class State(Enum):
     CLOSING = 3
     OPENING = 4
 
-# https://stackoverflow.com/a/48741004
-class RepeatTimer(Timer):
+# What Home Assistant's cover expects on the state topic
+STATE_PAYLOADS = {
+    State.UNKNOWN: "unknown",
+    State.CLOSED: "closed",
+    State.OPEN: "open",
+    State.CLOSING: "closing",
+    State.OPENING: "opening",
+}
+
+# Runs relay pulses one at a time on its own thread, so the MQTT network
+# thread never sleeps on GPIO timing
+class RelayExecutor:
+    def __init__(self, pin):
+        self.pin = pin
+        self.pending = deque() # commands waiting or being pulsed
+        self.condition = Condition()
+        self.last_pulse = 0.0
+        thread = Thread(target=self.run, name="relay", daemon=True)
+        thread.start()
+
+    def submit(self, command):
+        # Every command is a pulse of a toggle, dropping one would leave the
+        # door going the other way. on_message already ignores repeats.
+        with self.condition:
+            self.pending.append(command)
+            self.condition.notify()
+
     def run(self):
-        while not self.finished.wait(self.interval):
-            self.function(*self.args, **self.kwargs)
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                command = self.pending[0]
+            wait = self.last_pulse + MIN_PULSE_GAP - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            print("Triggering relay (%s)" % command)
+            gpio.output(self.pin, gpio.HIGH)
+            time.sleep(PULSE_TIME)
+            gpio.output(self.pin, gpio.LOW)
+            self.last_pulse = time.monotonic()
+            with self.condition:
+                self.pending.popleft()
 
 class GarageDoor:
     def __init__(self, client, name = "Garage Door"):
@@ -32,149 +84,149 @@ class GarageDoor:
         self.last_sensor_state = False
         self.debounced_sensor_state = False
         self.name = name
-        self.timeLastChanged = time.time_ns()
+        name_normalized = discovery.normalize(name)
+        self.entity = discovery.Entity("cover", name,
+            discovery.device(name_normalized, "Garage Door"),
+            "homeassistant/garage_door/%s/state" % name_normalized,
+            client.availability_topic,
+            unique_id="garagedoor",
+            command_topic="homeassistant/garage_door/%s/command" % name_normalized,
+            device_class="garage")
+        self.timeLastChanged = time.monotonic()
         self.state = State.UNKNOWN
+        self.last_edge = None
+        self.edge = Condition()
+        self.relay = RelayExecutor(OPENER_PIN)
     
     def read(self):
         self.sensor_state = gpio.input(SENSOR_PIN)
         # Fancy logic to ensure that the state is stable before reporting it as changed
         if self.sensor_state != self.last_sensor_state:
-            self.timeLastChanged = time.time()
-        if (time.time_ns() - self.timeLastChanged) > 2000000000: # nanoseconds
+            self.timeLastChanged = time.monotonic()
+        if (time.monotonic() - self.timeLastChanged) > DEBOUNCE_TIME:
             if self.debounced_sensor_state != self.sensor_state:
                 self.debounced_sensor_state = self.sensor_state
-                self.report()
+                self.report(EVENT)
         self.last_sensor_state = self.sensor_state
+
+    # Called from the RPi.GPIO event thread on every sensor edge
+    def on_edge(self, pin):
+        with self.edge:
+            self.last_edge = time.monotonic()
+            self.edge.notify()
+
+    # Sleeps until an edge arrives, then until the sensor has been stable for
+    # DEBOUNCE_TIME since the last edge, and only then reads and reports it
+    def watch(self):
+        gpio.add_event_detect(SENSOR_PIN, gpio.BOTH, callback=self.on_edge)
+        while True:
+            with self.edge:
+                while True:
+                    if self.last_edge is None:
+                        self.edge.wait()
+                        continue
+                    remaining = self.last_edge + DEBOUNCE_TIME - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    # A newer edge moves the deadline out
+                    self.edge.wait(remaining)
+                self.last_edge = None
+            self.sensor_state = gpio.input(SENSOR_PIN)
+            self.last_sensor_state = self.sensor_state
+            if self.debounced_sensor_state != self.sensor_state:
+                self.debounced_sensor_state = self.sensor_state
+                self.report(EVENT)
         
-    def trigger(self):
-        # Just trigger the relay, could be open or close
-        gpio.output(OPENER_PIN, gpio.HIGH)
-        time.sleep(0.100)
-        gpio.output(OPENER_PIN, gpio.LOW)
-        pass
+    def trigger(self, command):
+        # Just trigger the relay, could be open or close. Returns immediately,
+        # the pulse happens on the relay thread.
+        self.relay.submit(command)
           
     def register(self):
-        name_normalized = self.name.lower().replace(" ", "_")
-        print("Registering %s with Home Assistant..." % name_normalized)
-        device = {
-            "identifiers": name_normalized,
-            "name": "Garage Door",
-            "model": "Garage Door",
-            "manufacturer": "",
-        }
-        topic = "homeassistant/cover/%s/config" % name_normalized
-        data = {
-            "name": self.name, 
-            "device_class": "garage",
-            "unique_id": "garagedoor",
-            "command_topic": "homeassistant/garage_door/%s/command" % name_normalized,
-            "state_topic": "homeassistant/garage_door/%s/state" % name_normalized,
-            "device": device,
-        }
-        try:
-            self.client.publish(topic, json.dumps(data), retain=True)
-        except:
-            pass
-        return
+        self.entity.register(self.client, retain=True)
         
-    def report(self):
+    def report(self, priority = REPORT):
         # For this sensor, high means closed
-        name_normalized = self.name.lower().replace(" ", "_")
-        #print("%s: %s = %s" % \
-        #    (name_normalized, self.debouncedState, "open" if self.debouncedState else "closed"))
-        topic = "homeassistant/garage_door/%s/state" % name_normalized
-        data = ""
         if not self.debounced_sensor_state and self.state != State.OPENING:
             self.state = State.CLOSED
         if self.debounced_sensor_state and self.state != State.CLOSING:
             self.state = State.OPEN
-        # Determine string
-        data = "unknown"
-        if self.state == State.OPEN:
-            data = "open"
-        elif self.state == State.OPENING:
-            data = "opening"
-        elif self.state == State.CLOSED:
-            data = "closed"
-        elif self.state == State.CLOSING:
-            data = "closing"
+        data = STATE_PAYLOADS[self.state]
         try:
             print("Reporting: %s" % data)
-            self.client.publish(topic, data)
+            self.client.publish(self.entity.state_topic, data, retain=True, priority=priority)
         except:
             pass
-        return
 
     def on_message(self, client, userdata, msg):
         if msg.topic == "homeassistant/register":
             self.register()
         else:
-            name_normalized = self.name.lower().replace(" ", "_")
-            if msg.topic == ("homeassistant/garage_door/%s/command" % name_normalized):
+            if msg.topic == self.entity.command_topic:
                 data = msg.payload.decode()
                 print("Received command: %s" % data)
                 if data == "OPEN":
                     if not (self.state == State.OPEN or self.state == State.OPENING):
                         self.state = State.OPENING
-                        self.trigger()
+                        self.trigger(data)
                 elif data == "CLOSE":
                     if not (self.state == State.CLOSED or self.state == State.CLOSING):
                         self.state = State.CLOSING
-                        self.trigger()
+                        self.trigger(data)
                 elif data == "STOP":
                     if (self.state == State.OPENING or self.state == State.CLOSING):
                         self.state = State.OPEN
-                        self.trigger()
-                self.report()
-                
-    def on_connect(self, client, userdata, flags, rc):
-        if rc == 0:
-            print("Connected")
-            client.subscribe("homeassistant/register")
-            client.subscribe("homeassistant/garage_door/#")
-        else:
-            print("Error connecting (%i)" % rc)
-        
-    def try_connect(self, client):
-        connected = False
-        while not connected:
-            try:
-                client.connect("192.168.1.9", 1883)
-            except:
-                print("Unable to connect... retrying...")
-                time.sleep(2)
-            else:
-                connected = True
-
-    def on_disconnect(self, client, userdata,  rc):
-        self.try_connect(client)
+                        self.trigger(data)
+                # Acknowledge the new state right away
+                self.report(EVENT)
 
-def main():
-    setproctitle.setproctitle('garagedoor')
-    # Must be in this order: create client, define callbacks, connect, 
-    # subscribe, start loop or proceed to do other things
-    client = mqtt.Client("mqtt_garagedoor_%u" % os.getpid())
+# Sets up the GPIO and the door, registers it and starts reporting, for
+# both main() and setup(). every is the host's Scheduler.every or
+# Runtime.every.
+def start(client, every):
     garage_door = GarageDoor(client)
-    client.on_message = garage_door.on_message
-    client.on_connect = garage_door.on_connect
-    client.on_disconnect = garage_door.on_disconnect
-    garage_door.try_connect(client)
-    client.loop_start()
     gpio.setmode(gpio.BCM)
     gpio.setup(SENSOR_PIN, gpio.IN, pull_up_down=gpio.PUD_UP)
     gpio.setup(OPENER_PIN, gpio.OUT)
     gpio.output(OPENER_PIN, gpio.LOW)
     garage_door.register()
-    # Use the repeating timer to send the reports every 15 seconds
-    timer = RepeatTimer(15, garage_door.report)
-    timer.daemon = True
-    timer.start()
-    # Take readings as often as possible
-    garage_door.read()
+    client.on_connected(lambda connection: garage_door.report())
+    every(HEARTBEAT_PERIOD, garage_door.report, name="garage door report")
+    # Start from the current sensor state
+    garage_door.sensor_state = gpio.input(SENSOR_PIN)
+    garage_door.last_sensor_state = garage_door.sensor_state
+    garage_door.debounced_sensor_state = garage_door.sensor_state
     garage_door.report()
-    while(1):
-        garage_door.read()
-        time.sleep(0.05)
+    # With edge detection the host runs watch() on a thread instead
+    if not USE_EDGE_DETECT:
+        every(POLL_PERIOD, garage_door.read, name="garage door read", priority=HIGH)
+    return garage_door
+
+def main():
+    setproctitle.setproctitle('garagedoor')
+    connection = Connection("mqtt_garagedoor_%u" % os.getpid(), AVAILABILITY_TOPIC)
+    for topic in TOPICS:
+        connection.subscribe(topic)
+    scheduler = Scheduler()
+    garage_door = start(connection, scheduler.every)
+    connection.client.on_message = garage_door.on_message
+    # Connects in the background, anything published before then is queued
+    connection.start()
+    if USE_EDGE_DETECT:
+        Thread(target=garage_door.watch, name="watch", daemon=True).start()
+    notify.heartbeat(scheduler)
+    notify.ready()
+    scheduler.run()
+
+# Entry point for runtime.py
+def setup(runtime):
+    garage_door = start(runtime.client, runtime.every)
+    for topic in TOPICS:
+        runtime.subscribe(topic, garage_door.on_message)
+    if USE_EDGE_DETECT:
+        # Sleeps until a sensor edge, so costs nothing while the door is still
+        runtime.thread(garage_door.watch)
+    runtime.on_shutdown(gpio.cleanup)
 
 if __name__ == "__main__":
     try:
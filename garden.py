@@ -1,16 +1,17 @@
 #!/usr/bin/python3
 
-import paho.mqtt.client as mqtt
 import time
-import json
 import os
-from threading import Timer
-import RPi.GPIO as gpio
-import board
-import busio
-import adafruit_ads1x15.ads1115 as ads
-from adafruit_ads1x15.analog_in import AnalogIn
+import signal
+import struct
+from array import array
+import hal
+from hal import gpio, board, busio, ads
 import setproctitle
+from connection import Connection, EVENT, REPORT
+from scheduler import Scheduler, HIGH, LOW
+import discovery
+import notify
 
 WET_VOLTAGE = 1.000
 DRY_VOLTAGE = 4.100
@@ -19,14 +20,39 @@ STATUS_PIN = 23
 VALVE_PIN = 21
 MAX_ON_TIME = 3600 # seconds
 REPORT_PERIOD = 60 # seconds
+FILTER_WINDOW = 100 # readings (one per second) in each sensor's moving average
+# Moisture sensor ADCs: I2C address, data rate (samples per second), channels used
+ADCS = [
+    (0x48, 128, 4),
+    (0x49, 128, 4),
+    # (0x4A, 128, 4),
+]
+# Sensor filter buffers are saved here so a restart doesn't have to re-fill
+# them, and are only used if saved less than STATE_MAX_AGE ago
+STATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "garden_state.bin")
+STATE_SAVE_PERIOD = 600 # seconds
+STATE_MAX_AGE = 900 # seconds
+# magic, version, time saved, sensor count, filter window
+STATE_HEADER = struct.Struct("<4sB3xdII")
+STATE_MAGIC = b"GRDN"
+# Publish all sensor readings and the valve state as one message on
+# AGGREGATE_TOPIC instead of one message per entity
+AGGREGATE_STATE = True
+AGGREGATE_TOPIC = "homeassistant/garden/state"
+# Only publish when some sensor's moisture moved more than this (%) or the
+# valve changed, 0 to publish every REPORT_PERIOD. State is retained, and
+# everything is re-sent at least every HEARTBEAT_PERIOD seconds regardless.
+DEADBAND = 1.0
+HEARTBEAT_PERIOD = 3600 # seconds
+STATS_PERIOD = 600 # seconds between scheduler timing reports
+# "online"/"offline" for Home Assistant, offline is our last will
+AVAILABILITY_TOPIC = "homeassistant/garden/availability"
+TOPICS = ["homeassistant/register", "homeassistant/garden/#"]
+DEVICE = discovery.device("Garden-Watering-System", "Garden Watering System")
+SENSOR_TEMPLATE = discovery.template(("moisture", "%.2f"), ("voltage_average", "%.3f"), ("voltage", "%.3f"))
+VALVE_TEMPLATE = discovery.template(("state", '"%s"'), ("override", "%s"))
 
-client = mqtt.Client("mqtt_garden_%u" % os.getpid())
-
-# https://stackoverflow.com/a/48741004
-class RepeatTimer(Timer):
-    def run(self):
-        while not self.finished.wait(self.interval):
-            self.function(*self.args, **self.kwargs)
+connection = Connection("mqtt_garden_%u" % os.getpid(), AVAILABILITY_TOPIC)
 
 def scale(value, inMin, inMax, outMin, outMax):
     percentage = (value - inMin) / (inMin - inMax)
@@ -34,98 +60,163 @@ def scale(value, inMin, inMax, outMin, outMax):
     outValue = max(min(outValue, outMax), outMin)
     return outValue
     
-def rotate(l, n = 1):
-    return l[-n:] + l[:-n]
-    
-def on_connect(client, userdata, flags, rc):
-    if rc == 0:
-        print("Connected", flush=True)
-        client.subscribe("homeassistant/register")
-        client.subscribe("homeassistant/garden/#")
-    else:
-        print("Error connecting (%i)" % rc, flush=True)
-        
-def on_disconnect(client, userdata,  rc):
-    print("Disconnected", flush=True)
-    try_connect()
+# Fixed-size window of readings with a running sum, so pushing a reading and
+# getting the average are O(1) however long the window is
+class RingBuffer:
+    def __init__(self, size):
+        self.values = array('d', bytes(8 * size))
+        self.index = 0
+        self.total = 0.0
+        self.latest = 0.0
+        self.count = 0 # readings in the buffer, until it's full
 
-def try_connect():
-    connected = False
-    while not connected:
-        try:
-            client.connect("192.168.1.9", 1883)
-        except:
-            print("Unable to connect... retrying...", flush=True)
-            time.sleep(2)
-        else:
-            connected = True
+    def push(self, value):
+        self.total = self.total + value - self.values[self.index]
+        self.values[self.index] = value
+        self.latest = value
+        self.index = (self.index + 1) % len(self.values)
+        if self.count < len(self.values):
+            self.count = self.count + 1
+        # Re-sum once per lap so floating point error can't build up
+        if self.index == 0:
+            self.total = sum(self.values)
+
+    # Average of what's been read so far until the buffer has filled
+    def average(self):
+        return self.total / max(self.count, 1)
+
+    # Oldest to newest
+    def ordered(self):
+        return self.values[self.index:] + self.values[:self.index]
+
+    def load(self, values):
+        self.values[:] = values
+        self.index = 0
+        self.total = sum(self.values)
+        self.latest = self.values[-1]
+        self.count = len(self.values)
 
+    def __len__(self):
+        return len(self.values)
+    
 id_counter = 1
 class Sensor:
     def __init__(self, client, adc, channel):
-        self.channel = AnalogIn(adc, channel);
+        self.adc = adc
+        self.channel = channel
         self.voltage = 0.000
         self.moisture = 0.0
-        self.buffer_size = 100
-        self.voltage = [0] * self.buffer_size
+        self.buffer = RingBuffer(FILTER_WINDOW)
         global id_counter
         self.id = id_counter
         id_counter = id_counter + 1
         self.name = "Garden Moisture %u" % (self.id)
         self.client = client
-        for i in range(self.buffer_size):
-            self.read()
+        state_topic = "homeassistant/garden/%s" % discovery.normalize(self.name)
+        value_template = "{{ value_json.moisture }}"
+        if AGGREGATE_STATE:
+            state_topic = AGGREGATE_TOPIC
+            value_template = "{{ value_json.%s }}" % discovery.normalize(self.name)
+        self.entity = discovery.Entity("sensor", self.name, DEVICE, state_topic,
+            client.availability_topic,
+            device_class="moisture",
+            icon="mdi:water-percent",
+            unit_of_measurement="%",
+            value_template=value_template)
         
+    # Starts a conversion, read() picks it up once it's done
+    def start(self):
+        hal.start_conversion(self.adc, self.channel)
+
     def read(self):
-        self.voltage = rotate(self.voltage)
-        self.voltage[0] = self.channel.voltage
-        average = sum(self.voltage) / len(self.voltage)
-        self.moisture = scale(average, DRY_VOLTAGE, WET_VOLTAGE, 0, 100);
+        self.voltage = hal.read_conversion(self.adc)
+        self.buffer.push(self.voltage)
+        self.moisture = scale(self.buffer.average(), DRY_VOLTAGE, WET_VOLTAGE, 0, 100);
         #if self.name == "Garden Moisture 4":
-        #    print("%s: %0.3fV - %0.3fV - %3.1f%%" % (self.name, self.voltage[0], average, self.moisture), flush=True)
+        #    print("%s: %0.3fV - %0.3fV - %3.1f%%" % (self.name, self.voltage, self.buffer.average(), self.moisture), flush=True)
     
     def register(self):
-        name_normalized = self.name.lower().replace(" ", "_")
-        print("Registering %s with Home Assistant..." % name_normalized, flush=True)
-        device = {
-            "identifiers": "Garden-Watering-System",
-            "name": "Garden Watering System",
-            "model": "Garden Watering System",
-            "manufacturer": "",
-        }
-        topic = "homeassistant/sensor/%s/config" % name_normalized
-        data = {
-            "name": self.name,
-            "device_class": "moisture",
-            "unique_id": name_normalized,
-            "icon": "mdi:water-percent",
-            "unit_of_measurement": "%",
-            "state_topic": "homeassistant/garden/%s" % name_normalized,
-            "value_template": "{{ value_json.moisture }}",
-            "device": device,
-        }
-        try:
-            self.client.publish(topic, json.dumps(data))
-        except:
-            pass
-        return
+        self.entity.register(self.client)
         
     def report(self):
-        name_normalized = self.name.lower().replace(" ", "_")
-        topic = "homeassistant/garden/%s" % name_normalized
-        average = sum(self.voltage) / len(self.voltage)
-        data = {
-            "moisture": round(self.moisture, 2),
-            "voltage_average": round(average, 3),
-            "voltage": round(self.voltage[0], 3)
-        }
+        payload = SENSOR_TEMPLATE % (self.moisture, self.buffer.average(), self.voltage)
         try:
-            self.client.publish(topic, json.dumps(data))
+            self.client.publish(self.entity.state_topic, payload, retain=True)
         except:
             print("MQTT error", flush=True)
-            pass
-        return   
         
+# Reads every sensor once, on the calling thread. Each step starts a
+# conversion on every ADC, sleeps one conversion time and reads them all
+# back, so the ADCs convert at the same time and nothing polls the bus
+# while they do.
+class Sweep:
+    def __init__(self, groups):
+        self.groups = groups # one list of sensors per ADC
+        self.last_time = 0.0
+        self.max_time = 0.0
+
+    def run(self):
+        start = time.monotonic()
+        for step in range(max(len(group) for group in self.groups)):
+            sensors = [group[step] for group in self.groups if step < len(group)]
+            for sensor in sensors:
+                sensor.start()
+            time.sleep(max(hal.conversion_time(sensor.adc) for sensor in sensors))
+            for sensor in sensors:
+                sensor.read()
+        self.last_time = time.monotonic() - start
+        self.max_time = max(self.max_time, self.last_time)
+
+    def report(self):
+        print("Sensor sweep took %.1fms (max %.1fms)" % (self.last_time * 1000, self.max_time * 1000), flush=True)
+        self.max_time = 0.0
+
+def save_state(sensors):
+    # Nothing worth keeping until the buffers have filled
+    if any(sensor.buffer.count < len(sensor.buffer) for sensor in sensors):
+        return
+    data = STATE_HEADER.pack(STATE_MAGIC, 1, time.time(), len(sensors), FILTER_WINDOW)
+    data = data + b"".join(sensor.buffer.ordered().tobytes() for sensor in sensors)
+    # Write to a temporary file and rename so a crash can't leave half a file
+    temp_path = STATE_PATH + ".tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, STATE_PATH)
+    except OSError as e:
+        print("Unable to save sensor state: %s" % e, flush=True)
+
+# Returns True if every sensor's buffer was restored
+def load_state(sensors):
+    try:
+        with open(STATE_PATH, "rb") as f:
+            data = f.read()
+        magic, version, saved, count, window = STATE_HEADER.unpack_from(data)
+    except (OSError, struct.error):
+        return False
+    age = time.time() - saved
+    if magic != STATE_MAGIC or version != 1 or count != len(sensors) or window != FILTER_WINDOW:
+        print("Ignoring saved sensor state, configuration changed", flush=True)
+        return False
+    if age < 0 or age > STATE_MAX_AGE:
+        print("Ignoring saved sensor state from %us ago" % age, flush=True)
+        return False
+    values = array('d')
+    try:
+        values.frombytes(data[STATE_HEADER.size:STATE_HEADER.size + 8 * count * window])
+    except ValueError:
+        return False
+    if len(values) != count * window:
+        return False
+    for i, sensor in enumerate(sensors):
+        sensor.buffer.load(values[i * window:(i + 1) * window])
+        sensor.moisture = scale(sensor.buffer.average(), DRY_VOLTAGE, WET_VOLTAGE, 0, 100)
+        sensor.voltage = sensor.buffer.latest
+    print("Restored sensor state from %us ago" % age, flush=True)
+    return True
+
 class Valve:
     def __init__(self, client, pin):
         self.pin = pin
@@ -134,35 +225,24 @@ class Valve:
         self.override_mode = False # Manual override
         self.name = "Garden Watering Valve"
         self.client = client
+        name_normalized = discovery.normalize(self.name)
+        state_topic = "homeassistant/garden/%s" % name_normalized
+        value_template = "{{ value_json.state }}"
+        if AGGREGATE_STATE:
+            state_topic = AGGREGATE_TOPIC
+            value_template = "{{ value_json.valve }}"
+        self.entity = discovery.Entity("switch", self.name, DEVICE, state_topic,
+            client.availability_topic,
+            command_topic="homeassistant/garden/%s/command" % name_normalized,
+            device_class="switch",
+            icon="mdi:pipe-valve",
+            value_template=value_template)
         self.on_time = 0
         gpio.setup(self.pin, gpio.OUT)
         self.update()
     
     def register(self):
-        name_normalized = self.name.lower().replace(" ", "_")
-        print("Registering %s with Home Assistant..." % name_normalized, flush=True)
-        device = {
-            "identifiers": "Garden-Watering-System",
-            "name": "Garden Watering System",
-            "model": "Garden Watering System",
-            "manufacturer": "",
-        }
-        topic = "homeassistant/switch/%s/config" % name_normalized
-        data = {
-            "name": self.name,
-            "device_class": "switch",
-            "unique_id": name_normalized,
-            "icon": "mdi:pipe-valve",
-            "state_topic": "homeassistant/garden/%s" % name_normalized,
-            "command_topic": "homeassistant/garden/%s/command" % name_normalized,
-            "value_template": "{{ value_json.state }}",
-            "device": device,
-        }
-        try:
-            self.client.publish(topic, json.dumps(data))
-        except:
-            pass
-        return
+        self.entity.register(self.client)
         
     def report(self):
         if valve.override_mode:
@@ -170,17 +250,14 @@ class Valve:
         if (time.time() - self.on_time) > MAX_ON_TIME:
             valve.override_mode = False
             valve.update()
-        name_normalized = self.name.lower().replace(" ", "_")
-        topic = "homeassistant/garden/%s" % name_normalized
-        data = {
-            "state": "ON" if self.state else "OFF",
-            "override": self.override_mode
-        }
+        if AGGREGATE_STATE:
+            report_state()
+            return
+        payload = VALVE_TEMPLATE % ("ON" if self.state else "OFF", "true" if self.override_mode else "false")
         try:
-            self.client.publish(topic, json.dumps(data))
+            self.client.publish(self.entity.state_topic, payload, retain=True)
         except:
             pass
-        return
     
     def update(self):
         self.state = self.water_mode or self.override_mode
@@ -196,15 +273,43 @@ class Valve:
         self.update()
         self.report()
         
+reported = None # (moisture readings, valve state) last published on AGGREGATE_TOPIC
+state_template = None # made once the sensors are known, in start()
+last_state_report = 0.0
+
+# One message for the whole system. Sends nothing if the valve hasn't changed
+# and no sensor has moved more than DEADBAND since the last one.
+def report_state(force = False):
+    global reported, last_state_report
+    moisture = [round(sensor.moisture, 2) for sensor in sensors]
+    switches = ("ON" if valve.state else "OFF", "true" if valve.override_mode else "false")
+    now = time.monotonic()
+    # The valve switching is an event, sensors drifting is just a report
+    switched = reported is None or switches != reported[1]
+    if not force and not switched and DEADBAND > 0 and now - last_state_report < HEARTBEAT_PERIOD:
+        if all(abs(value - last) <= DEADBAND for value, last in zip(moisture, reported[0])):
+            return
+    try:
+        connection.publish(AGGREGATE_TOPIC, state_template % (*moisture, *switches),
+                           retain=True, priority=EVENT if switched else REPORT)
+    except:
+        print("MQTT error", flush=True)
+        return
+    reported = (moisture, switches)
+    last_state_report = now
+
+# Re-send the state on every (re)connect, in case the broker lost it
+def on_connected(connection):
+    if AGGREGATE_STATE and state_template is not None:
+        report_state(force=True)
+
 def on_message(client, userdata, msg):
     if msg.topic == "homeassistant/register":
         for sensor in sensors:
             sensor.register()
         valve.register()
     else:
-        name_normalized = valve.name.lower().replace(" ", "_")
-        command_topic = "homeassistant/garden/%s/command" % name_normalized
-        if msg.topic == command_topic:
+        if msg.topic == valve.entity.command_topic:
             data = msg.payload.decode().lower()
             if data == "on":
                 valve.override_mode = True
@@ -220,26 +325,19 @@ def blink():
     status_led = not status_led
     gpio.output(STATUS_PIN, status_led)
 
-def main():
-    setproctitle.setproctitle('garden')
-    # Set up MQTT
-    client.on_message = on_message
-    client.on_connect = on_connect
-    client.on_disconnect = on_disconnect
-    try_connect()
-    client.loop_start()
+# Sets up the valve, status LED and sensors, registers everything and adds
+# the jobs, for both main() and setup(). every is the host's Scheduler.every
+# or Runtime.every.
+def start(every):
     # Set up GPIO
     gpio.setmode(gpio.BCM)
     # Set up valve
     global valve
-    valve = Valve(client, VALVE_PIN)
+    valve = Valve(connection, VALVE_PIN)
     valve.register()
-    # Blink LED to indicate program is running
     gpio.setup(STATUS_PIN, gpio.OUT)
     global status_led
     status_led = False
-    timer = RepeatTimer(0.750, blink)
-    timer.start()
     # Set up override mode switch
     #gpio.setup(OVERRIDE_PIN, gpio.IN, pull_up_down=gpio.PUD_DOWN)
     #gpio.add_event_detect(OVERRIDE_PIN, gpio.BOTH, callback=valve.override_switched)
@@ -248,39 +346,81 @@ def main():
     i2c = busio.I2C(board.SCL, board.SDA)
     global sensors
     sensors = []
-    adc48 = ads.ADS1115(i2c, address=0x48)
-    sensors.append(Sensor(client, adc48, 0))
-    sensors.append(Sensor(client, adc48, 1))
-    sensors.append(Sensor(client, adc48, 2))
-    sensors.append(Sensor(client, adc48, 3))
-    adc49 = ads.ADS1115(i2c, address=0x49)
-    sensors.append(Sensor(client, adc49, 0))
-    sensors.append(Sensor(client, adc49, 1))
-    sensors.append(Sensor(client, adc49, 2))
-    sensors.append(Sensor(client, adc49, 3))
-    # adc4A = ads.ADS1115(i2c, address=0x4A)
-    # sensors.append(Sensor(client, adc4A, 0))
-    # sensors.append(Sensor(client, adc4A, 1))
-    # sensors.append(Sensor(client, adc4A, 2))
-    # sensors.append(Sensor(client, adc4A, 3))
+    groups = []
+    for address, data_rate, channels in ADCS:
+        adc = ads.ADS1115(i2c, address=address, data_rate=data_rate)
+        group = [Sensor(connection, adc, channel) for channel in range(channels)]
+        groups.append(group)
+        sensors.extend(group)
+    sweep = Sweep(groups)
+    global state_template
+    state_template = discovery.template(*[(sensor.entity.id, "%.2f") for sensor in sensors],
+                                        ("valve", '"%s"'), ("override", "%s"))
+    # Pick up the filter buffers from the last run. Otherwise the averages
+    # start from a single reading and fill in as readings come.
+    if not load_state(sensors):
+        sweep.run()
+    sweep.report()
     for sensor in sensors:
         sensor.register()
-        sensor.report()
-    while(1):
-        # Report every x seconds
-        for i in range(REPORT_PERIOD):
-            # Take readings every 1 second
-            for sensor in sensors:
-                sensor.read()
-            time.sleep(1)
+        if not AGGREGATE_STATE:
+            sensor.report()
+    if AGGREGATE_STATE:
+        report_state(force=True)
+    connection.on_connected(on_connected)
+    # Readings every second and a report every REPORT_PERIOD, each on its own
+    # deadlines so the time spent reading doesn't add up as drift
+    every(1, sweep.run, name="garden sweep", priority=HIGH, blocking=True)
+    every(REPORT_PERIOD, report, sweep, name="garden report")
+    every(STATE_SAVE_PERIOD, save_state, sensors, name="garden save", priority=LOW, blocking=True)
+    # Blink LED to indicate program is running
+    every(0.750, blink, name="garden blink", priority=LOW)
+
+def report(sweep):
+    if not AGGREGATE_STATE:
         for sensor in sensors:
             sensor.report()
-        valve.report()
+    valve.report()
+    sweep.report()
+
+def main():
+    setproctitle.setproctitle('garden')
+    # Set up MQTT, connects in the background and queues anything
+    # published before then
+    connection.client.on_message = on_message
+    for topic in TOPICS:
+        connection.subscribe(topic)
+    connection.start()
+    scheduler = Scheduler()
+    start(scheduler.every)
+    scheduler.every(STATS_PERIOD, scheduler.report_stats, name="stats", priority=LOW)
+    notify.heartbeat(scheduler)
+    notify.ready()
+    scheduler.run()
+
+# Entry point for runtime.py
+def setup(runtime):
+    global connection
+    connection = runtime.client
+    for topic in TOPICS:
+        runtime.subscribe(topic, on_message)
+    start(runtime.every)
+    runtime.on_shutdown(lambda: save_state(sensors))
+    runtime.on_shutdown(gpio.cleanup)
+
+def on_sigterm(signum, frame):
+    raise KeyboardInterrupt
+
+sensors = []
 
 if __name__ == "__main__":
+    # Shut down the same way on kill as on Ctrl-C
+    signal.signal(signal.SIGTERM, on_sigterm)
     try:
         main()
     except KeyboardInterrupt:
+        if sensors:
+            save_state(sensors)
         gpio.cleanup()
         os._exit(0)
     
@@ -0,0 +1,352 @@
+# Hardware the scripts talk to, so they can run off the Pi. Normally these
+# are just the real libraries:
+#
+#   from hal import gpio                  # RPi.GPIO
+#   from hal import board, busio          # Blinka
+#   from hal import ads, AnalogIn         # adafruit_ads1x15 (CircuitPython)
+#   from hal import Adafruit_ADS1x15      # the legacy ADS1x15 library
+#
+# With HA_SIM=1 in the environment they are simulated instead: ADS1115s that
+# play back scripted or recorded waveforms with the chip's conversion and I2C
+# timing, and a GPIO with scripted input edges and event callbacks. See
+# bench.py for driving them.
+#
+# Each library is only imported when a script asks for it, so the garage
+# door doesn't need the ADC libraries installed and so on.
+
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+
+SIMULATED = os.environ.get("HA_SIM") == "1"
+
+# Full scale voltage for each ADS1115 gain setting
+GAINS = {2/3: 6.144, 1: 4.096, 2: 2.048, 4: 1.024, 8: 0.512, 16: 0.256}
+DATA_RATES = [8, 16, 32, 64, 128, 250, 475, 860]
+# One register read or write at 100kHz, address + pointer + 2 data bytes
+I2C_TRANSACTION = 0.0004 # seconds
+# ADS1115 registers and config bits for starting a single-shot conversion,
+# see start_conversion()
+CONVERSION_REGISTER = 0x00
+CONFIG_REGISTER = 0x01
+CONFIG_START = 0x8000 # also reads back set once the conversion is done
+CONFIG_SINGLE_ENDED = 0x4000 # channel n is mux setting 4 + n
+CONFIG_SINGLE_SHOT = 0x0100
+CONFIG_COMPARATOR_OFF = 0x0003
+CONFIG_GAINS = {2/3: 0x0000, 1: 0x0200, 2: 0x0400, 4: 0x0600, 8: 0x0800, 16: 0x0A00}
+# The chip's clock is only good to 10%, so a conversion can take that much
+# longer than 1/data rate
+CONVERSION_MARGIN = 1.1
+
+# Waveforms are functions of time.monotonic() returning volts. Constant level
+# plus gaussian noise, which is what an idle input looks like.
+class Noise:
+    def __init__(self, level, noise = 0.002):
+        self.level = level
+        self.noise = noise
+
+    def __call__(self, t):
+        return self.level + random.gauss(0.0, self.noise)
+
+# Plays back recorded samples, e.g. a doorbell capture, from the first time
+# it's read, looping at the end
+class Recording:
+    def __init__(self, samples, data_rate, loop = True):
+        self.samples = samples
+        self.data_rate = data_rate
+        self.loop = loop
+        self.start = None
+
+    def __call__(self, t):
+        if self.start is None:
+            self.start = t
+        i = int((t - self.start) * self.data_rate)
+        if self.loop:
+            i = i % len(self.samples)
+        else:
+            i = min(i, len(self.samples) - 1)
+        return float(self.samples[i])
+
+# Waveform on each simulated ADC input, keyed by (I2C address, channel).
+# Inputs nobody has set idle at mid scale.
+signals = {}
+
+def signal(address, channel):
+    return signals.get((address, channel)) or Noise(2.0)
+
+# Stand-in for an I2C bus, only one transaction on it at a time
+class SimI2C:
+    def __init__(self, scl = None, sda = None):
+        self.lock = threading.Lock()
+
+    def transaction(self):
+        with self.lock:
+            time.sleep(I2C_TRANSACTION)
+
+    def deinit(self):
+        pass
+
+def counts(volts, gain):
+    full_scale = GAINS[gain]
+    return max(-32768, min(32767, int(round(volts / full_scale * 32767))))
+
+# The legacy Adafruit_ADS1x15.ADS1115: single-shot reads plus continuous mode
+class LegacyADS1115:
+    def __init__(self, address = 0x48, busnum = None, i2c = None, **kwargs):
+        self.address = address
+        self.bus = SimI2C()
+        self.continuous = None # (channel, gain, data rate, start time)
+
+    def read_adc(self, channel, gain = 1, data_rate = None):
+        data_rate = data_rate or 128
+        self.bus.transaction()
+        # The library sleeps a conversion plus a little margin
+        time.sleep(1.0 / data_rate + 0.0001)
+        self.bus.transaction()
+        return counts(signal(self.address, channel)(time.monotonic()), gain)
+
+    def start_adc(self, channel, gain = 1, data_rate = None):
+        data_rate = data_rate or 128
+        if data_rate not in DATA_RATES:
+            raise ValueError("Data rate must be one of: %s" % DATA_RATES)
+        self.bus.transaction()
+        time.sleep(1.0 / data_rate + 0.0001)
+        self.continuous = (channel, gain, data_rate, time.monotonic())
+        return self.get_last_result()
+
+    # The conversion register holds the last finished conversion, so reading
+    # faster than the data rate gets the same sample again
+    def get_last_result(self):
+        if self.continuous is None:
+            raise IOError("ADC is not converting")
+        channel, gain, data_rate, start = self.continuous
+        self.bus.transaction()
+        n = int((time.monotonic() - start) * data_rate)
+        return counts(signal(self.address, channel)(start + n / data_rate), gain)
+
+    def stop_adc(self):
+        self.bus.transaction()
+        self.continuous = None
+
+# adafruit_ads1x15.ads1115.ADS1115, single-shot only as garden.py uses it
+class SimADS1115:
+    def __init__(self, i2c, gain = 1, data_rate = None, mode = None, address = 0x48):
+        self.i2c = i2c
+        self.gain = gain
+        self.data_rate = data_rate or 128
+        self.address = address
+        self.conversion = None # (channel, time it finishes)
+        self.result = 0
+
+    # Register access as the library does it, for start_conversion() and
+    # read_conversion()
+    def _write_register(self, reg, value):
+        self.i2c.transaction()
+        if reg == CONFIG_REGISTER and value & CONFIG_START:
+            channel = (value >> 12) & 0x03
+            self.conversion = (channel, time.monotonic() + 1.0 / self.data_rate)
+
+    def _read_register(self, reg, fast = False):
+        self.i2c.transaction()
+        done = self.conversion is None or time.monotonic() >= self.conversion[1]
+        if reg == CONFIG_REGISTER:
+            return CONFIG_START if done else 0
+        # Until the conversion finishes the register holds the last one
+        if done and self.conversion is not None:
+            channel, end = self.conversion
+            self.result = counts(signal(self.address, channel)(end), self.gain) & 0xFFFF
+            self.conversion = None
+        return self.result
+
+    def read(self, channel):
+        # Start the conversion, wait for it off the bus, then read it back
+        self.i2c.transaction()
+        time.sleep(1.0 / self.data_rate)
+        self.i2c.transaction()
+        return counts(signal(self.address, channel)(time.monotonic()), self.gain)
+
+class SimAnalogIn:
+    def __init__(self, adc, positive_pin, negative_pin = None):
+        self.adc = adc
+        self.pin = positive_pin
+
+    @property
+    def value(self):
+        return self.adc.read(self.pin)
+
+    @property
+    def voltage(self):
+        return self.value * GAINS[self.adc.gain] / 32767
+
+# Starts a single-shot conversion of channel on an adafruit_ads1x15 ADS1115
+# and returns without waiting for it, which the library's own read() can't
+# do. After conversion_time() read_conversion() gets the result, so one
+# thread can keep several ADCs converting at once without polling the bus.
+def start_conversion(adc, channel):
+    config = CONFIG_START | CONFIG_SINGLE_ENDED | channel << 12 | CONFIG_GAINS[adc.gain] | \
+             CONFIG_SINGLE_SHOT | DATA_RATES.index(adc.data_rate) << 5 | CONFIG_COMPARATOR_OFF
+    adc._write_register(CONFIG_REGISTER, config)
+
+def conversion_time(adc):
+    return CONVERSION_MARGIN / adc.data_rate
+
+# Volts
+def read_conversion(adc):
+    value = adc._read_register(CONVERSION_REGISTER)
+    if value & 0x8000:
+        value = value - 0x10000
+    return value * GAINS[adc.gain] / 32767
+
+# Namespaces standing in for the library modules
+class Namespace:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+# RPi.GPIO with inputs driven by the simulation. Edge callbacks run on one
+# event thread, like the real library's.
+class SimGPIO:
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.levels = {}
+        self.callbacks = {} # pin: (edge, [callback])
+        self.outputs = {} # pin: deque of (time, level) written
+        self.events = None
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down = PUD_OFF, initial = LOW):
+        with self.lock:
+            if direction == self.OUT:
+                self.levels[pin] = initial
+                self.outputs.setdefault(pin, deque(maxlen=1000))
+            elif pin not in self.levels:
+                self.levels[pin] = self.HIGH if pull_up_down == self.PUD_UP else self.LOW
+
+    def input(self, pin):
+        return self.levels.get(pin, self.LOW)
+
+    def output(self, pin, level):
+        with self.lock:
+            self.levels[pin] = level
+            self.outputs.setdefault(pin, deque(maxlen=1000)).append((time.monotonic(), level))
+
+    def add_event_detect(self, pin, edge, callback = None, bouncetime = None):
+        with self.lock:
+            if self.events is None:
+                self.events = queue.Queue()
+                threading.Thread(target=self.run_events, name="gpio", daemon=True).start()
+            self.callbacks[pin] = (edge, [callback] if callback else [])
+
+    def add_event_callback(self, pin, callback):
+        self.callbacks[pin][1].append(callback)
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def cleanup(self, pins = None):
+        with self.lock:
+            self.callbacks.clear()
+
+    def run_events(self):
+        while True:
+            pin, callbacks = self.events.get()
+            for callback in callbacks:
+                callback(pin)
+
+    # Simulation side: change an input as the outside world would
+    def set_input(self, pin, level):
+        with self.lock:
+            old = self.levels.get(pin, self.LOW)
+            self.levels[pin] = level
+            if old == level or pin not in self.callbacks:
+                return
+            edge, callbacks = self.callbacks[pin]
+            if edge == self.BOTH or edge == (self.RISING if level else self.FALLING):
+                self.events.put((pin, callbacks))
+
+    # Plays a list of (seconds from now, level) on a thread of its own
+    def play(self, pin, edges):
+        start = time.monotonic()
+        def run():
+            for t, level in edges:
+                delay = start + t - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                self.set_input(pin, level)
+        thread = threading.Thread(target=run, name="gpio-script", daemon=True)
+        thread.start()
+        return thread
+
+def load_gpio():
+    if SIMULATED:
+        return SimGPIO()
+    import RPi.GPIO
+    return RPi.GPIO
+
+def load_board():
+    if SIMULATED:
+        return Namespace(SCL=3, SDA=2)
+    import board
+    return board
+
+def load_busio():
+    if SIMULATED:
+        return Namespace(I2C=SimI2C)
+    import busio
+    return busio
+
+def load_ads():
+    if SIMULATED:
+        return Namespace(ADS1115=SimADS1115, P0=0, P1=1, P2=2, P3=3)
+    import adafruit_ads1x15.ads1115
+    return adafruit_ads1x15.ads1115
+
+def load_analog_in():
+    if SIMULATED:
+        return SimAnalogIn
+    from adafruit_ads1x15.analog_in import AnalogIn
+    return AnalogIn
+
+def load_legacy_ads():
+    if SIMULATED:
+        return Namespace(ADS1115=LegacyADS1115)
+    import Adafruit_ADS1x15
+    return Adafruit_ADS1x15
+
+loaders = {
+    "gpio": load_gpio,
+    "board": load_board,
+    "busio": load_busio,
+    "ads": load_ads,
+    "AnalogIn": load_analog_in,
+    "Adafruit_ADS1x15": load_legacy_ads,
+}
+
+# Loads each backend the first time it's asked for, then it's a plain
+# module attribute
+def __getattr__(name):
+    if name not in loaders:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = loaders[name]()
+    globals()[name] = value
+    return value
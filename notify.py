@@ -0,0 +1,46 @@
+# sd_notify(3) style messages to whatever started the script, supervisor.py
+# or systemd, over the datagram socket named in NOTIFY_SOCKET. Started any
+# other way there's no socket and they go nowhere.
+#
+#   notify.ready()               # up and about to start its main loop
+#   notify.heartbeat(scheduler)  # WATCHDOG=1 from a job on the main loop
+#
+# The heartbeat runs as a job on the loop it vouches for, so if the loop
+# hangs the heartbeats stop and the script gets restarted.
+
+import os
+import socket
+
+from scheduler import HIGH
+
+def notify(message):
+    path = os.environ.get("NOTIFY_SOCKET")
+    if not path:
+        return
+    # A leading @ is the abstract namespace
+    if path.startswith("@"):
+        path = "\0" + path[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(message.encode(), path)
+    except OSError:
+        pass
+
+def ready():
+    notify("READY=1")
+
+# Seconds between heartbeats, half the timeout we were given in
+# WATCHDOG_USEC, or None if nobody is watching
+def watchdog_period():
+    try:
+        return int(os.environ["WATCHDOG_USEC"]) / 2e6
+    except (KeyError, ValueError):
+        return None
+
+def watchdog():
+    notify("WATCHDOG=1")
+
+def heartbeat(scheduler):
+    period = watchdog_period()
+    if period is not None:
+        scheduler.every(period, watchdog, priority=HIGH, delay=0)
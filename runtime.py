@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+
+# Runs several of the device scripts in one process, sharing one MQTT
+# connection and one asyncio event loop for their timers and messages:
+#
+#   ./runtime.py doorbell garagedoor garden
+#
+# Each script provides setup(runtime), which creates its objects and hooks
+# them up with runtime.subscribe/every/thread/on_shutdown. Message callbacks
+# and timers run on the event loop, never on paho's network thread. Loops
+# that block on hardware (doorbell sampling, garage door edges) get a thread.
+
+import paho.mqtt.client as mqtt
+import asyncio
+import importlib
+import os
+import signal
+import socket
+import sys
+import threading
+import traceback
+import setproctitle
+from connection import Connection
+from scheduler import Job
+import notify
+
+STATS_PERIOD = 600 # seconds between timer timing reports
+
+class Runtime:
+    # client is a Connection, which the scripts publish through
+    def __init__(self, client):
+        self.client = client
+        self.loop = None
+        self.subscriptions = [] # (topic filter, callback)
+        self.shutdown_hooks = []
+        self.tasks = []
+        self.jobs = []
+
+    # callback(client, userdata, msg), same as a paho on_message
+    def subscribe(self, topic, callback):
+        self.subscriptions.append((topic, callback))
+        self.client.subscribe(topic)
+
+    # Calls function(*args) every interval seconds. Runs are scheduled from
+    # deadlines so they don't drift, and overruns and lateness are counted
+    # as scheduler.py does. Blocking ones run in a worker thread. priority is
+    # accepted so scripts can set up the same jobs as for a Scheduler, here
+    # every timer is its own task.
+    def every(self, interval, function, *args, blocking = False, name = None, priority = None):
+        job = Job(name or function.__name__, interval, function, args, None)
+        self.jobs.append(job)
+        self.tasks.append(self.loop.create_task(self.repeat(job, blocking)))
+
+    # For loops that never return, so they don't hold up shutdown
+    def thread(self, function, *args):
+        thread = threading.Thread(target=function, args=args, daemon=True)
+        thread.start()
+
+    def on_shutdown(self, function):
+        self.shutdown_hooks.append(function)
+
+    # loop.time() is monotonic, like the scheduler's deadlines
+    async def repeat(self, job, blocking):
+        deadline = self.loop.time() + job.interval
+        while True:
+            await asyncio.sleep(max(0, deadline - self.loop.time()))
+            start = self.loop.time()
+            try:
+                if blocking:
+                    await self.loop.run_in_executor(None, job.function, *job.args)
+                else:
+                    job.function(*job.args)
+            except Exception:
+                traceback.print_exc()
+            end = self.loop.time()
+            job.record(start - deadline, end - start)
+            deadline = job.reschedule(deadline, end)
+
+    def report_stats(self):
+        for job in self.jobs:
+            print(job.stats(), flush=True)
+            job.reset_stats()
+
+    # paho network thread, hand the message over to the event loop
+    def on_message(self, client, userdata, msg):
+        self.loop.call_soon_threadsafe(self.dispatch, client, userdata, msg)
+
+    def dispatch(self, client, userdata, msg):
+        for topic, callback in self.subscriptions:
+            if mqtt.topic_matches_sub(topic, msg.topic):
+                try:
+                    callback(client, userdata, msg)
+                except Exception:
+                    traceback.print_exc()
+
+    def shutdown(self):
+        for function in self.shutdown_hooks:
+            try:
+                function()
+            except Exception:
+                traceback.print_exc()
+
+    async def run(self, modules):
+        self.loop = asyncio.get_running_loop()
+        self.loop.add_signal_handler(signal.SIGTERM, self.stop)
+        self.stopped = asyncio.Event()
+        for module in modules:
+            print("Starting %s" % module.__name__, flush=True)
+            module.setup(self)
+        self.every(STATS_PERIOD, self.report_stats, name="stats")
+        # Heartbeats for supervisor.py come from the event loop itself
+        period = notify.watchdog_period()
+        if period is not None:
+            self.every(period, notify.watchdog)
+        notify.ready()
+        await self.stopped.wait()
+
+    def stop(self):
+        self.stopped.set()
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: %s script [script...]" % sys.argv[0])
+        sys.exit(1)
+    setproctitle.setproctitle('runtime')
+    modules = [importlib.import_module(name) for name in sys.argv[1:]]
+    # One connection, so one availability topic for everything it hosts
+    connection = Connection("mqtt_runtime_%u" % os.getpid(),
+                            "homeassistant/%s/availability" % socket.gethostname())
+    runtime = Runtime(connection)
+    connection.client.on_message = runtime.on_message
+    # Connects in the background, the scripts' publishes are queued until then
+    connection.start()
+    try:
+        asyncio.run(runtime.run(modules))
+    except KeyboardInterrupt:
+        pass
+    runtime.shutdown()
+    connection.stop()
+    os._exit(0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# Runs a script's periodic jobs on one thread. Each job keeps to its own grid
+# of time.monotonic() deadlines, so time spent running doesn't pile up as
+# drift. When several jobs are due at once the highest priority one goes
+# first, but never the same job twice in a row while others are waiting, so
+# one that can't keep up doesn't starve the rest. A run that finishes past
+# the job's next deadline is an overrun: the next run starts late, and any
+# deadlines missed entirely are skipped rather than run back to back.
+#
+# A loop that paces itself, like the doorbell sampler, is added as the
+# continuous job instead. It runs whenever no other job is due and has no
+# deadlines of its own, so the others run in the gaps between its runs.
+#
+#   scheduler = Scheduler()
+#   scheduler.every(1, sweep.run, name="sweep", priority=HIGH)
+#   scheduler.every(0.75, blink, priority=LOW)
+#   scheduler.run()
+
+import heapq
+import time
+import traceback
+
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+class Job:
+    def __init__(self, name, interval, function, args, priority):
+        self.name = name
+        self.interval = interval
+        self.function = function
+        self.args = args
+        self.priority = priority
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.late_total = 0.0
+        self.late_max = 0.0 # seconds a run started after its deadline
+        self.busy_max = 0.0 # seconds a run took
+
+    def record(self, late, busy):
+        self.runs = self.runs + 1
+        self.late_total = self.late_total + late
+        self.late_max = max(self.late_max, late)
+        self.busy_max = max(self.busy_max, busy)
+
+    # Deadline for the run after the one due at deadline, which finished at
+    # end. Finishing past it is an overrun, deadlines missed entirely are
+    # skipped.
+    def reschedule(self, deadline, end):
+        deadline = deadline + self.interval
+        if deadline <= end:
+            self.overruns = self.overruns + 1
+            missed = int((end - deadline) // self.interval)
+            self.skipped = self.skipped + missed
+            deadline = deadline + missed * self.interval
+        return deadline
+
+    def stats(self):
+        if self.interval is None:
+            return "%s: %u runs, took up to %.1fms, continuous" % (self.name, self.runs, self.busy_max * 1000)
+        late = self.late_total / self.runs if self.runs else 0.0
+        return "%s: %u runs, started %.1fms late on average (max %.1fms), took up to %.1fms, %u overruns, %u skipped" % \
+               (self.name, self.runs, late * 1000, self.late_max * 1000, self.busy_max * 1000,
+                self.overruns, self.skipped)
+
+class Scheduler:
+    def __init__(self):
+        self.jobs = []
+        self.queue = [] # heap of (deadline, priority, sequence, job)
+        self.sequence = 0
+        self.running = False
+        self.last = None # job that ran last
+        self.continuous_job = None
+
+    # Calls function(*args) every interval seconds, the first time after
+    # delay seconds (default one interval). blocking is accepted so scripts
+    # can set up the same jobs here and in runtime.py, everything runs on
+    # this thread regardless.
+    def every(self, interval, function, *args, name = None, priority = NORMAL, delay = None, blocking = False):
+        job = Job(name or function.__name__, interval, function, args, priority)
+        self.jobs.append(job)
+        self.push(time.monotonic() + (interval if delay is None else delay), job)
+        return job
+
+    # Calls function(*args) over and over whenever nothing else is due
+    def continuous(self, function, *args, name = None):
+        job = Job(name or function.__name__, None, function, args, None)
+        self.jobs.append(job)
+        self.continuous_job = job
+        return job
+
+    def push(self, deadline, job):
+        heapq.heappush(self.queue, (deadline, job.priority, self.sequence, job))
+        self.sequence = self.sequence + 1
+
+    # Sleeps until something is due, then takes the most important job of
+    # those that are. With a continuous job there's no sleeping, it runs
+    # instead (with no deadline).
+    def next(self):
+        while True:
+            now = time.monotonic()
+            if not self.queue or self.queue[0][0] > now:
+                if self.continuous_job is not None:
+                    return None, self.continuous_job
+                time.sleep(self.queue[0][0] - now)
+                continue
+            due = []
+            while self.queue and self.queue[0][0] <= now:
+                due.append(heapq.heappop(self.queue))
+            due.sort(key=lambda entry: (entry[1], entry[0]))
+            first = due[0]
+            if first[3] is self.last and len(due) > 1:
+                first = due[1]
+            for entry in due:
+                if entry is not first:
+                    heapq.heappush(self.queue, entry)
+            return first[0], first[3]
+
+    def run(self):
+        self.running = True
+        while self.running:
+            deadline, job = self.next()
+            self.last = job
+            start = time.monotonic()
+            try:
+                job.function(*job.args)
+            except Exception:
+                traceback.print_exc()
+            end = time.monotonic()
+            if deadline is None:
+                job.record(0.0, end - start)
+                continue
+            job.record(start - deadline, end - start)
+            self.push(job.reschedule(deadline, end), job)
+
+    def stop(self):
+        self.running = False
+
+    def report_stats(self):
+        for job in self.jobs:
+            print(job.stats(), flush=True)
+            job.reset_stats()
@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+
+# Starts the device scripts and keeps them running, in place of a cron job
+# checking ps once a minute:
+#
+#   ./supervisor.py doorbell garagedoor garden
+#   ./supervisor.py "runtime doorbell garden"
+#
+# Each script gets a socket of its own in NOTIFY_SOCKET and sends WATCHDOG=1
+# on it from its main loop (see notify.py). One that exits is restarted as
+# soon as it's noticed, one that stops sending heartbeats is killed and
+# restarted. Restarts back off while a script keeps failing, and each one is
+# logged with how long the script was down. Scripts' output is appended to
+# <script>.log next to them.
+
+import argparse
+import json
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+WATCHDOG_TIMEOUT = 20 # seconds without a heartbeat before a script counts as hung
+START_TIMEOUT = 120 # seconds a script has to send its first heartbeat
+RESTART_MIN = 1.0 # seconds before the first restart
+RESTART_MAX = 300.0 # seconds, the backoff doubles up to this
+STABLE_TIME = 600 # seconds a script must stay up for the backoff to reset
+KILL_TIMEOUT = 5 # seconds between SIGTERM and SIGKILL
+POLL_PERIOD = 0.5 # seconds between checks on the scripts
+# Restart counts and downtime for each script, rewritten on every change
+STATUS_PATH = os.path.join(DIRECTORY, "supervisor_status.json")
+
+class Child:
+    def __init__(self, command):
+        self.args = command.split()
+        self.name = self.args[0]
+        self.script = os.path.join(DIRECTORY, self.name + ".py")
+        self.log_path = os.path.join(DIRECTORY, self.name + ".log")
+        # Abstract namespace, so there's no file to clean up
+        self.address = "@supervisor-%u-%s" % (os.getpid(), self.name)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind("\0" + self.address[1:])
+        self.socket.setblocking(False)
+        self.process = None
+        self.started = 0.0
+        self.last_heartbeat = None
+        self.stopping = None # when SIGTERM was sent
+        self.next_start = 0.0
+        self.failures = 0 # restarts in a row without staying up STABLE_TIME
+        self.restarts = 0
+        self.down_since = None
+        self.downtime = 0.0
+        self.last_exit = None
+
+    def start(self):
+        env = dict(os.environ, NOTIFY_SOCKET=self.address, WATCHDOG_USEC=str(int(WATCHDOG_TIMEOUT * 1e6)))
+        with open(self.log_path, "ab") as log:
+            self.process = subprocess.Popen([sys.executable, self.script] + self.args[1:], cwd=DIRECTORY, env=env,
+                                            stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                                            start_new_session=True)
+        self.started = time.monotonic()
+        self.last_heartbeat = None
+        self.stopping = None
+        print("Started %s (pid %u)" % (self.name, self.process.pid), flush=True)
+
+    def receive(self):
+        while True:
+            try:
+                message = self.socket.recv(4096)
+            except BlockingIOError:
+                return
+            if self.process is None:
+                continue
+            for line in message.decode(errors="replace").splitlines():
+                if line in ("READY=1", "WATCHDOG=1"):
+                    self.last_heartbeat = time.monotonic()
+                    if self.down_since is not None:
+                        down = self.last_heartbeat - self.down_since
+                        self.downtime = self.downtime + down
+                        self.down_since = None
+                        print("%s is back after %.1fs down (%u restarts, %.1fs down in total)" % \
+                              (self.name, down, self.restarts, self.downtime), flush=True)
+                        write_status()
+
+    # SIGTERM first so it can clean up, SIGKILL if it won't go
+    def stop(self, now):
+        if self.stopping is None:
+            self.stopping = now
+            self.process.terminate()
+        elif now - self.stopping > KILL_TIMEOUT:
+            self.process.kill()
+
+    def check(self, now):
+        if self.process is None:
+            if now >= self.next_start:
+                self.start()
+            return
+        rc = self.process.poll()
+        if rc is not None:
+            self.exited(now, rc)
+            return
+        if self.stopping is not None:
+            self.stop(now)
+        elif self.last_heartbeat is None and now - self.started > START_TIMEOUT:
+            print("%s never sent a heartbeat, restarting" % self.name, flush=True)
+            self.down_since = self.started
+            self.stop(now)
+        elif self.last_heartbeat is not None and now - self.last_heartbeat > WATCHDOG_TIMEOUT:
+            print("%s missed its heartbeat for %.0fs, restarting" % (self.name, now - self.last_heartbeat), flush=True)
+            # It was last known to be working at its last heartbeat
+            self.down_since = self.last_heartbeat
+            self.stop(now)
+
+    def exited(self, now, rc):
+        if self.down_since is None:
+            self.down_since = now
+        if now - self.started > STABLE_TIME:
+            self.failures = 0
+        delay = min(RESTART_MAX, RESTART_MIN * 2 ** self.failures)
+        self.failures = self.failures + 1
+        self.restarts = self.restarts + 1
+        self.last_exit = rc
+        self.process = None
+        self.next_start = now + delay
+        print("%s exited (%i), restarting in %.0fs" % (self.name, rc, delay), flush=True)
+        write_status()
+
+    def status(self):
+        down = self.downtime
+        if self.down_since is not None:
+            down = down + time.monotonic() - self.down_since
+        return {
+            "pid": self.process.pid if self.process else None,
+            "up": self.process is not None and self.down_since is None,
+            "restarts": self.restarts,
+            "downtime": round(down, 1),
+            "last_exit": self.last_exit,
+        }
+
+children = []
+stopped = False
+
+def write_status():
+    status = {child.name: child.status() for child in children}
+    status["time"] = time.time()
+    try:
+        with open(STATUS_PATH + ".tmp", "w") as f:
+            json.dump(status, f, indent=2)
+        os.replace(STATUS_PATH + ".tmp", STATUS_PATH)
+    except OSError as e:
+        print("Unable to write %s: %s" % (STATUS_PATH, e), flush=True)
+
+def on_signal(signum, frame):
+    global stopped
+    stopped = True
+
+def shutdown():
+    for child in children:
+        if child.process is not None:
+            child.process.terminate()
+    deadline = time.monotonic() + KILL_TIMEOUT
+    for child in children:
+        if child.process is not None:
+            try:
+                child.process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                child.process.kill()
+                child.process.wait()
+    print("Stopped", flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Start the device scripts and restart them if they die or hang")
+    parser.add_argument("scripts", nargs="+", metavar="script", help="script name, with any arguments in quotes")
+    args = parser.parse_args()
+    for command in args.scripts:
+        child = Child(command)
+        if not os.path.exists(child.script):
+            parser.error("no such script %s" % child.script)
+        children.append(child)
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    sockets = {child.socket: child for child in children}
+    write_status()
+    while not stopped:
+        now = time.monotonic()
+        for child in children:
+            child.check(now)
+        readable, _, _ = select.select(list(sockets), [], [], POLL_PERIOD)
+        for sock in readable:
+            sockets[sock].receive()
+    shutdown()
+    write_status()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())